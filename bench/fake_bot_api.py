@@ -0,0 +1,157 @@
+"""Minimal in-process stand-in for a Telegram Bot API server, used by the benchmark.
+
+It answers the methods the bot calls with plausible results, hands out queued updates to
+getUpdates long polling, and reports every call to an `on_call(method, params, result)`
+callback so the benchmark can follow each chat. Uploaded files are read and discarded.
+"""
+import asyncio
+import itertools
+import json
+import re
+import time
+from urllib.parse import parse_qsl
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    """Decode the parameters of a Bot API request; file parts of multipart bodies are skipped"""
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        return dict(parse_qsl(body.decode()))
+    match = re.search(r'boundary="?([^";]+)', content_type)
+    if match is None:
+        return {}
+    params = {}
+    for part in body.split(b'--' + match.group(1).encode()):
+        head, separator, value = part.partition(b'\r\n\r\n')
+        name = re.search(rb'name="([^"]+)"', head)
+        if separator and name and b'filename=' not in head:
+            params[name.group(1).decode()] = value[:-2].decode()
+    return params
+
+class FakeBotApi:
+    """Bot API server on 127.0.0.1 that records calls instead of talking to Telegram"""
+
+    def __init__(self, on_call=None):
+        self.on_call = on_call
+        self.uploaded_bytes = 0
+        self.polling = asyncio.Event()  # Set once the bot starts polling for updates
+        self._updates = []
+        self._new_update = asyncio.Condition()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._server = None
+
+    async def start(self) -> int:
+        """Start listening and return the port"""
+        self._server = await asyncio.start_server(self._handle_connection, '127.0.0.1', 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def send_text(self, chat_id: int, text: str) -> None:
+        """Queue a text message from a user for the bot to receive"""
+        update_id = next(self._update_ids)
+        self._updates.append({
+            'update_id': update_id,
+            'message': {
+                'message_id': next(self._message_ids), 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            },
+        })
+        async with self._new_update:
+            self._new_update.notify_all()
+
+    def _message(self, chat_id, **fields) -> dict:
+        return {
+            'message_id': fields.pop('message_id', None) or next(self._message_ids), 'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'}, 'from': BOT_USER, **fields,
+        }
+
+    def _file(self) -> dict:
+        file_id = next(self._file_ids)
+        return {'file_id': f'bench-file-{file_id}', 'file_unique_id': f'bench-unique-{file_id}'}
+
+    async def _get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        self.polling.set()
+        if not self._updates:
+            async with self._new_update:
+                try:
+                    await asyncio.wait_for(self._new_update.wait(), float(params.get('timeout') or 0))
+                except asyncio.TimeoutError:
+                    pass
+        return list(self._updates)
+
+    async def _dispatch(self, method: str, params: dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if method == 'sendMessage':
+            return self._message(params['chat_id'], text=params.get('text'))
+        if method == 'editMessageText':
+            return self._message(params['chat_id'], message_id=int(params['message_id']), text=params.get('text'))
+        if method == 'sendDocument':
+            return self._message(params['chat_id'], document=self._file())
+        if method == 'sendAudio':
+            return self._message(params['chat_id'], audio={**self._file(), 'duration': 0})
+        if method == 'sendMediaGroup':
+            media = json.loads(params['media']) if isinstance(params['media'], str) else params['media']
+            return [self._message(params['chat_id'], document=self._file()) for _ in media]
+        return True
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: dict) -> bytes:
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if not size:
+                    return b''.join(chunks)
+                chunks.append(chunk[:-2])
+        return await reader.readexactly(int(headers.get('content-length', 0)))
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # HTTP/1.1 with keep-alive, the bot's client reuses connections
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                _, target, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode().partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await self._read_body(reader, headers)
+                self.uploaded_bytes += len(body)
+
+                method = target.split('?')[0].rsplit('/', 1)[-1]
+                params = parse_params(headers.get('content-type', ''), body)
+                result = await self._dispatch(method, params)
+                if self.on_call is not None:
+                    self.on_call(method, params, result)
+
+                payload = json.dumps({'ok': True, 'result': result}).encode()
+                writer.write(
+                    b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                    b'Content-Length: %d\r\n\r\n' % len(payload) + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Cancelled when the benchmark stops while the bot is long polling
+            pass
+        finally:
+            writer.close()
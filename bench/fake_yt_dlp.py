@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""Offline stand-in for the yt-dlp executable, used by the benchmark (set YTDLP_BIN to this file).
+
+URLs look like https://bench.invalid/<id>/<duration>s_<size>mb. The video for a duration and size is
+generated once with ffmpeg's testsrc2 into BENCH_MEDIA_DIR, then "downloaded" by copying it at
+BENCH_DOWNLOAD_SPEED_MBPS while printing yt-dlp style progress lines. Playlists of such videos look like
+https://bench.invalid/playlist/<count>x<duration>s_<size>mb and can be listed with --flat-playlist.
+Only the options the bot uses are understood.
+"""
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+MB_IN_BYTES = 1024 * 1024
+MEDIA_DIR = os.getenv('BENCH_MEDIA_DIR', os.path.join(tempfile.gettempdir(), 'video-dl-bench-media'))  # Generated videos, reused across runs
+DOWNLOAD_SPEED_MBPS = float(os.getenv('BENCH_DOWNLOAD_SPEED_MBPS', 50))  # 0 copies at disk speed
+URL_RE = re.compile(r'/(?P<duration>\d+)s_(?P<size>\d+)mb/?$')
+PLAYLIST_URL_RE = re.compile(r'/playlist/(?P<count>\d+)x(?P<item>\d+s_\d+mb)/?$')
+
+# Options that take a value; everything else starting with '-' is a flag
+VALUE_OPTIONS = {
+    '-f', '-o', '--print', '--load-info-json', '--audio-format', '--audio-quality', '--merge-output-format',
+    '--retries', '--fragment-retries', '--retry-sleep', '--sleep-requests', '--sleep-interval',
+    '--max-sleep-interval', '--concurrent-fragments', '--proxy', '--cookies-from-browser',
+    '--downloader', '--downloader-args', '--playlist-items',
+}
+
+def parse_url(url: str) -> tuple:
+    """Return (duration seconds, size MB) encoded in a benchmark URL"""
+    match = URL_RE.search(url)
+    if match is None:
+        raise ValueError(f"Unsupported URL: {url}")
+    return int(match['duration']), int(match['size'])
+
+def media_path(duration: int, size_mb: int) -> str:
+    """Return the test video for a duration and size, generating it the first time"""
+    path = os.path.join(MEDIA_DIR, f'{duration}s_{size_mb}mb.mp4')
+    if os.path.exists(path):
+        return path
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    audio_kbps = 128
+    video_kbps = max(100, int(size_mb * MB_IN_BYTES * 8 / 1000 / duration) - audio_kbps)
+    temp_path = f'{path}.{os.getpid()}.tmp.mp4'
+    subprocess.run([
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'lavfi', '-i', f'testsrc2=size=854x480:rate=30:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        # Noise keeps the encoder from undershooting the bitrate on the synthetic picture
+        '-vf', 'noise=alls=40:allf=t',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '60',
+        '-b:v', f'{video_kbps}k', '-maxrate', f'{video_kbps}k', '-bufsize', f'{video_kbps * 2}k',
+        '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-shortest', '-movflags', 'faststart', temp_path
+    ], check=True)
+    os.replace(temp_path, path)
+    return path
+
+def parse_args(argv: list) -> tuple:
+    """Split arguments into ({option: [values]}, set of flags, positional arguments)"""
+    options, flags, positional = {}, set(), []
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in VALUE_OPTIONS:
+            options.setdefault(arg, []).append(argv[i + 1])
+            i += 2
+            continue
+        if arg.startswith('-'):
+            flags.add(arg)
+        else:
+            positional.append(arg)
+        i += 1
+    return options, flags, positional
+
+def build_info(url: str) -> dict:
+    duration, size_mb = parse_url(url)
+    size = os.path.getsize(media_path(duration, size_mb))
+    fmt = {
+        'format_id': '18', 'ext': 'mp4', 'vcodec': 'avc1.64001f', 'acodec': 'mp4a.40.2',
+        'height': 480, 'width': 854, 'filesize': size, 'tbr': size * 8 / 1000 / duration,
+    }
+    return {
+        'id': url.rstrip('/').split('/')[-2], 'title': url.rstrip('/').split('/')[-1], 'webpage_url': url,
+        'duration': duration, 'ext': 'mp4', 'formats': [fmt], **fmt,
+    }
+
+def playlist_entries(url: str, items: str) -> list:
+    """Return the flat entries of a benchmark playlist URL, limited by a --playlist-items range like '1:20'"""
+    match = PLAYLIST_URL_RE.search(url)
+    if match is None:
+        return None
+    start, _, end = (items or '1:').partition(':')
+    count = min(int(match['count']), int(end or match['count']))
+    return [
+        {'_type': 'url', 'url': f"https://bench.invalid/{match['count']}x{match['item']}-{index}/{match['item']}"}
+        for index in range(int(start or 1), count + 1)
+    ]
+
+def dump_json(urls: list, options: dict, flags: set) -> int:
+    """Print the metadata of each URL on its own line, continuing past errors with --ignore-errors"""
+    returncode = 0
+    for url in urls:
+        entries = playlist_entries(url, options.get('--playlist-items', [None])[-1])
+        try:
+            if entries is not None and '--flat-playlist' in flags:
+                for entry in entries:
+                    print(json.dumps(entry), flush=True)
+            else:
+                print(json.dumps(build_info(url)), flush=True)
+        except (TypeError, ValueError) as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            returncode = 1
+            if '--ignore-errors' not in flags:
+                break
+    return returncode
+
+def copy_with_progress(source: str, destination: str) -> None:
+    """Copy a file at DOWNLOAD_SPEED_MBPS, continuing a partial .part file like yt-dlp does"""
+    total = os.path.getsize(source)
+    part_path = f'{destination}.part'
+    done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    started, started_bytes, last_report = time.monotonic(), done, 0.0
+    with open(source, 'rb') as src, open(part_path, 'ab') as dst:
+        src.seek(done)
+        while True:
+            chunk = src.read(MB_IN_BYTES)
+            if not chunk:
+                break
+            dst.write(chunk)
+            done += len(chunk)
+            elapsed = time.monotonic() - started
+            if DOWNLOAD_SPEED_MBPS:
+                ahead = (done - started_bytes) / MB_IN_BYTES / DOWNLOAD_SPEED_MBPS - elapsed
+                if ahead > 0:
+                    time.sleep(ahead)
+                    elapsed += ahead
+            if elapsed - last_report >= 0.5 or done == total:
+                last_report = elapsed
+                speed = (done - started_bytes) / max(elapsed, 1e-3)
+                eta = int((total - done) / speed) if speed else 0
+                print(
+                    f"[download] {done / total * 100:5.1f}% of {total / MB_IN_BYTES:.2f}MiB "
+                    f"at {speed / MB_IN_BYTES:.2f}MiB/s ETA {eta // 60:02d}:{eta % 60:02d}",
+                    flush=True
+                )
+    os.replace(part_path, destination)
+
+def main(argv: list) -> int:
+    options, flags, positional = parse_args(argv)
+    if '--dump-json' in flags:
+        return dump_json(positional, options, flags)
+    url = positional[-1] if positional else None
+    if '--load-info-json' in options:
+        with open(options['--load-info-json'][-1]) as f:
+            url = json.load(f)['webpage_url']
+    try:
+        info = build_info(url)
+    except (TypeError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        return 1
+
+    template = options.get('-o', ['%(title)s.%(ext)s'])[-1]
+    video_path = os.path.abspath(template.replace('%(ext)s', 'mp4').replace('%(title)s', info['title']))
+    copy_with_progress(media_path(*parse_url(url)), video_path)
+    output_path = video_path
+
+    if '-x' in flags:
+        audio_format = options.get('--audio-format', ['best'])[-1]
+        extension = 'm4a' if audio_format == 'best' else audio_format
+        output_path = os.path.splitext(video_path)[0] + f'.{extension}'
+        codec = ['-c:a', 'copy'] if extension == 'm4a' else []
+        subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', video_path, '-vn', *codec, output_path], check=True)
+        os.remove(video_path)
+
+    for template in options.get('--print', []):
+        if template.startswith('after_move:'):
+            print(template[len('after_move:'):].replace('%(filepath)s', output_path), flush=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
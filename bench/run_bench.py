@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""Offline load test of the bot.
+
+Runs video_dl_bot.py as a subprocess against a fake Bot API server (fake_bot_api.py), with
+fake_yt_dlp.py as its yt-dlp. A number of simulated users each send their requests one after
+another. The run reports end-to-end latency percentiles, jobs per minute, and the peak disk and
+memory use of the bot and its child processes. Results are saved as JSON, and --baseline compares
+them with an earlier run.
+
+Example:
+    python bench/run_bench.py --users 4 --requests 3 --mix 30s_10mb:3,120s_80mb:1 --baseline bench/results/base.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_SCRIPT = os.path.join(os.path.dirname(BENCH_DIR), 'video_dl_bot.py')
+FAKE_YTDLP = os.path.join(BENCH_DIR, 'fake_yt_dlp.py')
+sys.path.insert(0, BENCH_DIR)
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+from fake_yt_dlp import media_path, parse_url  # noqa: E402
+
+MB_IN_BYTES = 1024 * 1024
+# Summary fields compared against a baseline, and whether higher is better
+COMPARED_FIELDS = {
+    'latency_p50': False, 'latency_p99': False, 'jobs_per_minute': True,
+    'peak_disk_mb': False, 'peak_memory_mb': False,
+}
+FAILURE_PREFIXES = (
+    'Download failed', 'Download completed but file not found', 'Error during', 'Failed to send',
+    "There isn't enough disk space", 'Audio download failed', 'Audio extraction failed',
+)
+
+def parse_mix(mix: str) -> list:
+    """Parse 'DURATIONs_SIZEmb:WEIGHT,...' into [(spec, weight)]"""
+    entries = []
+    for item in mix.split(','):
+        spec, _, weight = item.strip().partition(':')
+        parse_url(f'/{spec}')
+        entries.append((spec, float(weight or 1)))
+    return entries
+
+def percentile(values: list, fraction: float):
+    """Nearest-rank percentile, or None for no values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def process_rss(pid: int) -> int:
+    """Resident memory in bytes of one process (Linux /proc)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        return 0
+
+def process_tree_rss(pid: int) -> int:
+    """Resident memory in bytes of a process and all its descendants (Linux /proc)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, fields after it are fixed
+                parent = int(f.read().rsplit(')', 1)[1].split()[1])
+            children.setdefault(parent, []).append(int(entry))
+        except (OSError, IndexError, ValueError):
+            pass
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        pending.extend(children.get(current, []))
+        total += process_rss(current)
+    return total
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+class RequestTracker:
+    """Follows the bot's messages to each chat to tell when its current request is done.
+
+    A request ends when its status message is edited to 'Finished.'. Its latency runs until the
+    last upload, or until 'Finished.' if nothing was uploaded.
+    """
+
+    def __init__(self):
+        self.current = {}  # chat_id -> record of the request in progress
+
+    def begin(self, chat_id: int, record: dict) -> asyncio.Future:
+        record.update(started=time.monotonic(), last_upload=None, failed=False, uploads=0)
+        record['done'] = asyncio.get_running_loop().create_future()
+        self.current[chat_id] = record
+        return record['done']
+
+    def on_call(self, method: str, params: dict, result) -> None:
+        if 'chat_id' not in params:
+            return
+        record = self.current.get(int(params['chat_id']))
+        if record is None:
+            return
+        if method in ('sendDocument', 'sendAudio', 'sendMediaGroup'):
+            record['last_upload'] = time.monotonic()
+            record['uploads'] += len(result) if isinstance(result, list) else 1
+        text = params.get('text') or ''
+        if method in ('sendMessage', 'editMessageText'):
+            if text.startswith(FAILURE_PREFIXES):
+                record['failed'] = True
+            if text.endswith('\nFinished.') and not record['done'].done():
+                record['done'].set_result(record['last_upload'] or time.monotonic())
+
+async def run_user(api: FakeBotApi, tracker: RequestTracker, chat_id: int, specs: list, timeout: float) -> list:
+    """Send one user's requests one after another and return their records"""
+    records = []
+    for index, spec in enumerate(specs):
+        record = {'chat_id': chat_id, 'spec': spec}
+        done = tracker.begin(chat_id, record)
+        await api.send_text(chat_id, f'https://bench.invalid/{chat_id}-{index}/{spec}')
+        try:
+            finished = await asyncio.wait_for(asyncio.shield(done), timeout)
+            record['latency'] = finished - record['started']
+        except asyncio.TimeoutError:
+            record['failed'] = True
+            record['latency'] = None
+        records.append({key: value for key, value in record.items() if key not in ('done', 'started', 'last_upload')})
+    return records
+
+async def sample_resources(pid: int, downloads_dir: str, peaks: dict, interval: float = 0.25) -> None:
+    while True:
+        peaks['disk'] = max(peaks['disk'], directory_size(downloads_dir))
+        peaks['memory'] = max(peaks['memory'], process_tree_rss(pid))
+        peaks['bot_memory'] = max(peaks['bot_memory'], process_rss(pid))
+        await asyncio.sleep(interval)
+
+def write_user_settings(work_dir: str, users: int, settings: dict) -> None:
+    """Give every simulated user the same settings overrides"""
+    with sqlite3.connect(os.path.join(work_dir, 'user_settings.db')) as connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT PRIMARY KEY, settings TEXT NOT NULL)')
+        connection.executemany(
+            'INSERT OR REPLACE INTO user_settings (user_id, settings) VALUES (?, ?)',
+            [(str(chat_id), json.dumps(settings)) for chat_id in range(1000, 1000 + users)]
+        )
+
+async def run_benchmark(args) -> dict:
+    mix = parse_mix(args.mix)
+    print("Preparing media...", flush=True)
+    for spec, _ in mix:
+        media_path(*parse_url(f'/{spec}'))
+
+    rng = random.Random(args.seed)
+    plans = {
+        chat_id: rng.choices([spec for spec, _ in mix], [weight for _, weight in mix], k=args.requests)
+        for chat_id in range(1000, 1000 + args.users)
+    }
+
+    work_dir = tempfile.mkdtemp(prefix='video-dl-bench-')
+    write_user_settings(work_dir, args.users, json.loads(args.settings))
+    tracker = RequestTracker()
+    api = FakeBotApi(on_call=tracker.on_call)
+    port = await api.start()
+
+    bot_env = dict(args.env)
+    env = {
+        **os.environ,
+        'BOT_TOKEN': '123456:bench',
+        'BOT_API_BASE_URL': f'http://127.0.0.1:{port}/bot',
+        'YTDLP_BIN': FAKE_YTDLP,
+        'UPLOAD_SIZE_LIMIT_MB': str(args.upload_limit_mb),
+        'BENCH_DOWNLOAD_SPEED_MBPS': str(args.download_speed),
+        **bot_env,
+    }
+    log_file = open(os.path.join(work_dir, 'bot_stdout.log'), 'w')
+    bot = subprocess.Popen([sys.executable, BOT_SCRIPT], cwd=work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    peaks = {'disk': 0, 'memory': 0, 'bot_memory': 0}
+    sampler = None
+    try:
+        await asyncio.wait_for(api.polling.wait(), 60)
+        sampler = asyncio.ensure_future(sample_resources(bot.pid, os.path.join(work_dir, 'downloads'), peaks))
+        print(f"Running {args.users} users x {args.requests} requests (work dir {work_dir})...", flush=True)
+        started = time.monotonic()
+        results = await asyncio.gather(*(
+            run_user(api, tracker, chat_id, specs, args.timeout) for chat_id, specs in plans.items()
+        ))
+        elapsed = time.monotonic() - started
+    finally:
+        if sampler is not None:
+            sampler.cancel()
+        bot.send_signal(signal.SIGINT)
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, bot.wait, 30)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        log_file.close()
+        await api.stop()
+        if not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    requests = [record for user_records in results for record in user_records]
+    latencies = [record['latency'] for record in requests if not record['failed'] and record['latency'] is not None]
+    completed = len(latencies)
+    summary = {
+        'requests': len(requests),
+        'completed': completed,
+        'failed': len(requests) - completed,
+        'elapsed_seconds': round(elapsed, 2),
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': max(latencies) if latencies else None,
+        'jobs_per_minute': round(completed / elapsed * 60, 2) if elapsed else None,
+        'peak_disk_mb': round(peaks['disk'] / MB_IN_BYTES, 1),
+        'peak_memory_mb': round(peaks['memory'] / MB_IN_BYTES, 1),
+        'peak_bot_memory_mb': round(peaks['bot_memory'] / MB_IN_BYTES, 1),
+        'uploaded_mb': round(api.uploaded_bytes / MB_IN_BYTES, 1),
+    }
+    for key in ('latency_p50', 'latency_p99', 'latency_max'):
+        if summary[key] is not None:
+            summary[key] = round(summary[key], 2)
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit or None,
+        'config': {
+            'users': args.users, 'requests': args.requests, 'mix': args.mix, 'seed': args.seed,
+            'upload_limit_mb': args.upload_limit_mb, 'download_speed': args.download_speed,
+            'settings': json.loads(args.settings), 'env': bot_env,
+        },
+        'summary': summary,
+        'requests': requests,
+    }
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> list:
+    """Print the change of each compared field and return the fields that got worse beyond `tolerance`"""
+    regressions = []
+    for field, higher_is_better in COMPARED_FIELDS.items():
+        old, new = baseline.get(field), summary.get(field)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(field)
+            flag = '  REGRESSION'
+        print(f"  {field:<16} {old:>10} -> {new:<10} ({change:+.1%}){flag}")
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=4, help='simulated users sending requests at the same time')
+    parser.add_argument('--requests', type=int, default=3, help='requests each user sends, one after another')
+    parser.add_argument('--mix', default='30s_10mb:3,120s_80mb:1', help='DURATIONs_SIZEmb:WEIGHT list of videos to request')
+    parser.add_argument('--seed', type=int, default=1, help='seed for picking videos from the mix')
+    parser.add_argument('--upload-limit-mb', type=int, default=50, help='UPLOAD_SIZE_LIMIT_MB of the bot')
+    parser.add_argument('--download-speed', type=float, default=50, help='fake download speed in MB/s, 0 for unlimited')
+    parser.add_argument('--settings', default='{}', help='JSON user settings overrides, e.g. \'{"compress_video": false}\'')
+    parser.add_argument('--env', action='append', default=[], type=lambda item: tuple(item.split('=', 1)),
+                        metavar='KEY=VALUE', help='extra environment for the bot, may be repeated')
+    parser.add_argument('--keep-work-dir', action='store_true', help="keep the bot's working directory and logs")
+    parser.add_argument('--timeout', type=float, default=900, help='seconds before a request counts as failed')
+    parser.add_argument('--output', help='where to save the results (default bench/results/<timestamp>.json)')
+    parser.add_argument('--baseline', help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    print(json.dumps(result['summary'], indent=2))
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', result['timestamp'].replace(':', '-') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.baseline} ({baseline.get('commit')}):")
+        if compare(result['summary'], baseline['summary'], args.tolerance):
+            return 1
+    return 1 if result['summary']['failed'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,23 +1,127 @@
 import os
+import pathlib
 import math
+import glob
 import logging
+import asyncio
 import subprocess
-import shlex
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import functools
+import importlib.util
+import io
+import multiprocessing
+import signal
+import sys
+from collections import deque, OrderedDict
+from contextlib import asynccontextmanager, contextmanager, ExitStack, redirect_stderr, redirect_stdout
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext, CallbackQueryHandler
 import json
+import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a boolean option from the environment"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
 # Constants
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL', 'http://127.0.0.1:8081/bot')
+LOCAL_BOT_API = env_flag('LOCAL_BOT_API')  # The Bot API server runs with --local and reads uploads from disk by path
+LOCAL_BOT_API_DIR = os.getenv('LOCAL_BOT_API_DIR')  # Path of the downloads directory on the Bot API server, if it differs
 MB_IN_BYTES = 1024 * 1024
-UPLOAD_SIZE_LIMIT_MB = int(os.getenv('UPLOAD_SIZE_LIMIT_MB', 50))
-SPLIT_SIZE_LIMIT_MB = int(os.getenv('SPLIT_SIZE_LIMIT_MB', 40)) #If one or more splitted file are bigger than UPLOAD_SIZE_LIMIT_MB, decrease this value
+UPLOAD_SIZE_LIMIT_MB = int(os.getenv('UPLOAD_SIZE_LIMIT_MB', 2000 if LOCAL_BOT_API else 50))
+SPLIT_SIZE_LIMIT_MB = int(os.getenv('SPLIT_SIZE_LIMIT_MB', 40))  # Part size used only when the keyframe index can't be read
+SPLIT_SIZE_MARGIN = 0.98  # Headroom for container headers when cutting parts by packet size
 SUBDIR = "downloads"
-SETTINGS_FILE = "user_settings.json"
+YTDLP_BIN = os.getenv('YTDLP_BIN', 'yt-dlp')  # yt-dlp executable
+YTDLP_IN_PROCESS = env_flag('YTDLP_IN_PROCESS', 'YTDLP_BIN' not in os.environ)  # Run yt-dlp as a library in warm worker processes
+YTDLP_WORKER_JOBS = int(os.getenv('YTDLP_WORKER_JOBS', 50))  # Jobs a yt-dlp worker runs before it is replaced
+COMPRESS_TWO_PASS = env_flag('COMPRESS_TWO_PASS')  # Two-pass encoding hits the target size more precisely but takes longer
+COMPRESS_MAX_HEIGHT = int(os.getenv('COMPRESS_MAX_HEIGHT', 720))  # Downscale taller videos when compressing, 0 to keep resolution
+COMPRESS_AUDIO_BITRATE_KBPS = int(os.getenv('COMPRESS_AUDIO_BITRATE_KBPS', 96))
+COMPRESS_MIN_VIDEO_BITRATE_KBPS = int(os.getenv('COMPRESS_MIN_VIDEO_BITRATE_KBPS', 200))  # Below this, split instead of compressing
+COMPRESS_SIZE_MARGIN = 0.95  # Headroom for container overhead and rate control overshoot
+
+AUDIO_FORMAT = os.getenv('AUDIO_FORMAT', 'best')  # 'best' keeps the original audio codec, or e.g. 'mp3' or 'm4a' to convert
+# Codecs that can be stream-copied into MP4 when remuxing
+MP4_COPY_CODECS = {'h264', 'hevc', 'av1', 'vp9', 'aac', 'mp3', 'opus', 'ac3', 'eac3', 'alac', 'flac'}
+# File extension for stream-copying an audio codec out of a video
+AUDIO_COPY_EXTENSIONS = {'aac': 'm4a', 'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'ogg', 'flac': 'flac'}
+
+# Encoder profiles for compression, selected with ENCODE_PROFILE
+ENCODE_PROFILES = {
+    'x264': {'codec': 'libx264', 'preset': 'superfast', 'options': ['-tag:v', 'avc1'], 'two_pass': True},
+    'x265': {'codec': 'libx265', 'preset': 'fast', 'options': ['-tag:v', 'hvc1'], 'two_pass': True},
+    'nvenc': {'codec': 'h264_nvenc', 'preset': 'p4', 'options': ['-tag:v', 'avc1'], 'two_pass': False},
+    'qsv': {'codec': 'h264_qsv', 'preset': 'faster', 'options': ['-tag:v', 'avc1'], 'two_pass': False},
+    'videotoolbox': {'codec': 'h264_videotoolbox', 'preset': None, 'options': ['-tag:v', 'avc1'], 'two_pass': False},
+}
+ENCODE_PROFILE = os.getenv('ENCODE_PROFILE', 'x264')
+ENCODE_CODEC = os.getenv('ENCODE_CODEC')  # Overrides the profile's ffmpeg encoder
+ENCODE_PRESET = os.getenv('ENCODE_PRESET')  # Overrides the profile's preset
+ENCODE_THREADS = int(os.getenv('ENCODE_THREADS', 0))  # Threads per encoder process, 0 for the encoder default
+CHUNKED_ENCODING = env_flag('CHUNKED_ENCODING')  # Encode long videos as keyframe-aligned chunks in parallel
+ENCODE_CHUNK_DURATION = int(os.getenv('ENCODE_CHUNK_DURATION', 60))  # Seconds per chunk
+CHUNKED_ENCODING_MIN_DURATION = int(os.getenv('CHUNKED_ENCODING_MIN_DURATION', 300))  # Shorter videos are encoded in one piece
+ENCODE_CHUNK_WORKERS = int(os.getenv('ENCODE_CHUNK_WORKERS', max(1, (os.cpu_count() or 1) // 4)))  # Chunks encoded at the same time
+PREFLIGHT_PROBE = env_flag('PREFLIGHT_PROBE')  # Read metadata with yt-dlp before downloading to pick a format that fits
+PREFLIGHT_CACHE_TTL = int(os.getenv('PREFLIGHT_CACHE_TTL', 300))  # Seconds probed metadata is reused
+MAX_SOURCE_SIZE_MB = int(os.getenv('MAX_SOURCE_SIZE_MB', 0))  # Refuse jobs whose download is estimated larger than this, 0 for no limit
+MAX_DURATION = int(os.getenv('MAX_DURATION', 0))  # Refuse videos longer than this many seconds, 0 for no limit
+PROCESS_TIMEOUT = int(os.getenv('PROCESS_TIMEOUT', 600))  # Seconds before yt-dlp or ffprobe is killed, ffmpeg runs aren't limited
+PROCESS_OUTPUT_LIMIT = int(os.getenv('PROCESS_OUTPUT_LIMIT', 64 * 1024))  # Characters of stdout/stderr kept per process
+PROGRESS_UPDATE_INTERVAL = float(os.getenv('PROGRESS_UPDATE_INTERVAL', 3))  # Minimum seconds between edits of a status message
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # Port of the Prometheus /metrics endpoint, 0 to disable
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
+STALL_TIMEOUT = int(os.getenv('STALL_TIMEOUT', 120))  # Kill a download that makes no progress for this many seconds
+SETTINGS_DB = os.getenv('SETTINGS_DB', 'user_settings.db')
+SETTINGS_FILE = "user_settings.json"  # Legacy settings file, imported into SETTINGS_DB on first start
+SETTINGS_FLUSH_DELAY = float(os.getenv('SETTINGS_FLUSH_DELAY', 1.0))  # Seconds changes are batched before being written
+JOB_JOURNAL_DB = os.getenv('JOB_JOURNAL_DB', 'jobs.db')  # Unfinished jobs, resumed after a restart
+JOB_MAX_RESUMES = int(os.getenv('JOB_MAX_RESUMES', 3))  # Give up on a job after it was interrupted this many times
+FILE_CACHE_DB = os.getenv('FILE_CACHE_DB', 'file_id_cache.db')
+FILE_CACHE_FILE = "file_id_cache.json"  # Legacy cache file, imported into FILE_CACHE_DB on first start
+FILE_CACHE_TTL = int(os.getenv('FILE_CACHE_TTL', 7 * 24 * 3600))  # Seconds a cached upload is reused
+FILE_CACHE_MAX_ENTRIES = int(os.getenv('FILE_CACHE_MAX_ENTRIES', 10000))
+
+# Job scheduling limits
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', 6))  # Jobs running at the same time across all users
+MAX_JOBS_PER_USER = int(os.getenv('MAX_JOBS_PER_USER', 1))  # Jobs running at the same time for one user
+MAX_QUEUED_JOBS = int(os.getenv('MAX_QUEUED_JOBS', 100))  # New requests are rejected once this many are waiting
+MAX_QUEUED_PER_USER = int(os.getenv('MAX_QUEUED_PER_USER', 5))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 3))  # Concurrent yt-dlp downloads
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', 1))  # Concurrent ffmpeg encodes/splits
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 4))  # Concurrent uploads to Telegram
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', 20))  # Links handled from one message, counting playlist items
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', 2))  # Links of one message processed at the same time
+
+# Scratch storage
+MIN_FREE_DISK_MB = int(os.getenv('MIN_FREE_DISK_MB', 1024))  # Downloads wait while they could leave less free disk space than this
+JOB_SPACE_ESTIMATE_MB = int(os.getenv('JOB_SPACE_ESTIMATE_MB', 1024))  # Space reserved for a job whose download size is unknown
+JOB_DIR_MAX_AGE = int(os.getenv('JOB_DIR_MAX_AGE', 24 * 3600))  # Seconds before scratch files of no running job are swept
+SWEEP_INTERVAL = int(os.getenv('SWEEP_INTERVAL', 600))  # Seconds between sweeps of the downloads directory
+
+# Uploads
+BOT_API_CONNECTIONS = int(os.getenv('BOT_API_CONNECTIONS', 32))  # Connections kept open to the Bot API server
+BOT_API_POOL_TIMEOUT = float(os.getenv('BOT_API_POOL_TIMEOUT', 30))  # Seconds a request waits for a free connection
+UPLOAD_MIN_TIMEOUT = float(os.getenv('UPLOAD_MIN_TIMEOUT', 60))  # Read/write timeout of an upload, in seconds
+UPLOAD_MIN_SPEED_MBPS = float(os.getenv('UPLOAD_MIN_SPEED_MBPS', 1))  # Larger uploads get timeouts that allow this speed
+UPLOAD_RETRIES = int(os.getenv('UPLOAD_RETRIES', 3))  # Retries of a failed upload
+UPLOAD_RETRY_DELAY = float(os.getenv('UPLOAD_RETRY_DELAY', 2))  # Seconds before the first retry, doubled after each
+UPLOAD_GROUP_SIZE = min(10, int(os.getenv('UPLOAD_GROUP_SIZE', 10)))  # Split parts sent together in one album, 1 to send separately
 
 # Default user settings
 DEFAULT_SETTINGS = {
@@ -29,54 +133,515 @@ DEFAULT_SETTINGS = {
     'cookies_browser': 'none',  # Browser to extract cookies from (chrome, firefox, edge, safari, etc.)
     'use_aria2': False,  # Use aria2c for faster downloads
     'force_ipv4': False,  # Force IPv4 connections
+    'expand_playlists': False,  # Download the items of playlist links instead of a single video
 }
 
-# User settings dictionary
+# User settings dictionary, filled lazily from the settings database
 user_settings = {}
+dirty_settings = set()
+settings_flush_task = None
+
+# Lookups use settings_db on the event loop; batched writes use settings_write_db in a worker thread.
+# WAL mode lets them run at the same time.
+settings_db = None
+settings_write_db = None
+settings_write_lock = threading.Lock()
+
+def open_settings_connection(path: str = SETTINGS_DB) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
 
 def load_settings():
-    """Load user settings from file"""
-    global user_settings
+    """Open the settings database, importing the legacy JSON settings file if there is one"""
+    global settings_db, settings_write_db
     try:
+        settings_write_db = open_settings_connection()
+        with settings_write_db:
+            settings_write_db.execute('CREATE TABLE IF NOT EXISTS user_settings (user_id TEXT PRIMARY KEY, settings TEXT NOT NULL)')
+        settings_db = open_settings_connection()
+
         if os.path.exists(SETTINGS_FILE):
             with open(SETTINGS_FILE, 'r') as f:
-                user_settings = json.load(f)
-                
-                # Update existing users with new settings
-                for user_id in user_settings:
-                    for key, default_value in DEFAULT_SETTINGS.items():
-                        if key not in user_settings[user_id]:
-                            user_settings[user_id][key] = default_value
-                save_settings()
+                legacy_settings = json.load(f)
+            write_settings_rows([(user_id, json.dumps(settings_overrides(settings))) for user_id, settings in legacy_settings.items()])
+            os.replace(SETTINGS_FILE, f"{SETTINGS_FILE}.migrated")
+            logger.info(f"Imported settings of {len(legacy_settings)} users from {SETTINGS_FILE}")
     except Exception as e:
         logger.error(f"Error loading settings: {e}")
 
-def save_settings():
-    """Save user settings to file"""
+def settings_overrides(settings: dict) -> dict:
+    """Return only the settings that differ from the defaults, so new defaults apply to everyone"""
+    return {key: value for key, value in settings.items() if DEFAULT_SETTINGS.get(key) != value}
+
+def write_settings_rows(rows: list) -> None:
+    """Write (user_id, settings JSON) rows in one transaction"""
+    with settings_write_lock, settings_write_db:
+        settings_write_db.executemany('INSERT OR REPLACE INTO user_settings (user_id, settings) VALUES (?, ?)', rows)
+
+def take_dirty_settings() -> list:
+    rows = [(user_id, json.dumps(settings_overrides(user_settings[user_id]))) for user_id in dirty_settings]
+    dirty_settings.clear()
+    return rows
+
+def flush_settings():
+    """Write pending settings changes right away"""
     try:
-        with open(SETTINGS_FILE, 'w') as f:
-            json.dump(user_settings, f)
+        if dirty_settings and settings_write_db is not None:
+            write_settings_rows(take_dirty_settings())
     except Exception as e:
         logger.error(f"Error saving settings: {e}")
 
+async def flush_settings_later():
+    """Write pending settings changes after SETTINGS_FLUSH_DELAY, batching everything changed meanwhile"""
+    await asyncio.sleep(SETTINGS_FLUSH_DELAY)
+    loop = asyncio.get_running_loop()
+    while dirty_settings:
+        try:
+            await loop.run_in_executor(None, write_settings_rows, take_dirty_settings())
+        except Exception as e:
+            logger.error(f"Error saving settings: {e}")
+
+def save_settings(user_id):
+    """Mark a user's settings as changed; they are written to the database shortly after"""
+    global settings_flush_task
+    dirty_settings.add(str(user_id))
+    if settings_flush_task is not None and not settings_flush_task.done():
+        return
+    try:
+        settings_flush_task = asyncio.get_running_loop().create_task(flush_settings_later())
+    except RuntimeError:
+        # No event loop running, write synchronously
+        flush_settings()
+
 def get_user_settings(user_id: int) -> dict:
     """Get settings for a specific user"""
-    if str(user_id) not in user_settings:
-        user_settings[str(user_id)] = DEFAULT_SETTINGS.copy()
-        save_settings()
-    return user_settings[str(user_id)]
+    key = str(user_id)
+    if key not in user_settings:
+        stored = {}
+        if settings_db is not None:
+            row = settings_db.execute('SELECT settings FROM user_settings WHERE user_id = ?', (key,)).fetchone()
+            if row is not None:
+                stored = json.loads(row[0])
+        user_settings[key] = {**DEFAULT_SETTINGS, **stored}
+    return user_settings[key]
+
+# Uploaded file cache: cache key -> {'created': timestamp, 'items': [{'type', 'file_id', 'caption'}]},
+# least recently used first. Lookups only use this dict; changed keys are written to FILE_CACHE_DB in batches.
+file_id_cache = OrderedDict()
+file_cache_db = None
+file_cache_write_lock = threading.Lock()
+dirty_file_cache = {}  # cache key -> last used timestamp
+file_cache_flush_task = None
+
+def load_file_id_cache():
+    """Open the uploaded file cache database, importing the legacy JSON cache file if there is one"""
+    global file_cache_db
+    try:
+        file_cache_db = open_settings_connection(FILE_CACHE_DB)
+        with file_cache_db:
+            file_cache_db.execute(
+                'CREATE TABLE IF NOT EXISTS file_cache '
+                '(key TEXT PRIMARY KEY, created REAL NOT NULL, last_used REAL NOT NULL, items TEXT NOT NULL)'
+            )
+
+        if os.path.exists(FILE_CACHE_FILE):
+            with open(FILE_CACHE_FILE, 'r') as f:
+                entries = json.load(f)
+            # Entries are stored least recently used first, spread them over the past seconds to keep that order
+            now = time.time() - len(entries)
+            write_file_cache_rows(
+                [(key, entry['created'], now + index, json.dumps(entry['items'])) for index, (key, entry) in enumerate(entries)], []
+            )
+            os.replace(FILE_CACHE_FILE, f"{FILE_CACHE_FILE}.migrated")
+            logger.info(f"Imported {len(entries)} cached uploads from {FILE_CACHE_FILE}")
+
+        with file_cache_db:
+            file_cache_db.execute('DELETE FROM file_cache WHERE created <= ?', (time.time() - FILE_CACHE_TTL,))
+        rows = file_cache_db.execute('SELECT key, created, items FROM file_cache ORDER BY last_used').fetchall()
+        evicted = rows[:max(0, len(rows) - FILE_CACHE_MAX_ENTRIES)]
+        for key, created, items in rows[len(evicted):]:
+            file_id_cache[key] = {'created': created, 'items': json.loads(items)}
+        if evicted:
+            write_file_cache_rows([], [key for key, _, _ in evicted])
+    except Exception as e:
+        logger.error(f"Error loading file cache: {e}")
+
+def write_file_cache_rows(rows: list, deleted_keys: list) -> None:
+    """Write (key, created, last used, items JSON) rows and delete keys in one transaction"""
+    with file_cache_write_lock, file_cache_db:
+        file_cache_db.executemany('INSERT OR REPLACE INTO file_cache (key, created, last_used, items) VALUES (?, ?, ?, ?)', rows)
+        file_cache_db.executemany('DELETE FROM file_cache WHERE key = ?', [(key,) for key in deleted_keys])
+
+def take_dirty_file_cache() -> tuple:
+    """Return (rows to write, keys to delete) for the cache keys changed since the last write"""
+    rows, deleted_keys = [], []
+    for key, last_used in dirty_file_cache.items():
+        entry = file_id_cache.get(key)
+        if entry is None:
+            deleted_keys.append(key)
+        else:
+            rows.append((key, entry['created'], last_used, json.dumps(entry['items'])))
+    dirty_file_cache.clear()
+    return rows, deleted_keys
+
+def flush_file_id_cache():
+    """Write pending file cache changes right away"""
+    try:
+        if dirty_file_cache and file_cache_db is not None:
+            write_file_cache_rows(*take_dirty_file_cache())
+    except Exception as e:
+        logger.error(f"Error saving file cache: {e}")
+
+async def flush_file_id_cache_later():
+    """Write pending file cache changes after SETTINGS_FLUSH_DELAY, batching everything changed meanwhile"""
+    await asyncio.sleep(SETTINGS_FLUSH_DELAY)
+    loop = asyncio.get_running_loop()
+    while dirty_file_cache:
+        try:
+            await loop.run_in_executor(None, write_file_cache_rows, *take_dirty_file_cache())
+        except Exception as e:
+            logger.error(f"Error saving file cache: {e}")
+
+def save_file_id_cache(key: str):
+    """Mark a cache key as changed, used or removed; it is written to the database shortly after"""
+    global file_cache_flush_task
+    if file_cache_db is None:
+        return
+    dirty_file_cache[key] = time.time()
+    if file_cache_flush_task is not None and not file_cache_flush_task.done():
+        return
+    try:
+        file_cache_flush_task = asyncio.get_running_loop().create_task(flush_file_id_cache_later())
+    except RuntimeError:
+        # No event loop running, write synchronously
+        flush_file_id_cache()
+
+def make_cache_key(refined_url: str, settings: dict) -> str:
+    """Build the cache key for a refined URL and the settings that change the output"""
+    if settings['audio_only']:
+        # Compression and splitting don't apply to audio
+        return f"{refined_url}|audio"
+    return f"{refined_url}|video|compress={int(settings['compress_video'])}|split={int(settings['split_large_files'])}"
+
+def get_cached_files(key: str):
+    """Return the cached uploads for a key, or None if missing or expired"""
+    entry = file_id_cache.get(key)
+    if entry is None:
+        return None
+    if time.time() - entry['created'] >= FILE_CACHE_TTL:
+        del file_id_cache[key]
+        save_file_id_cache(key)
+        return None
+    file_id_cache.move_to_end(key)
+    save_file_id_cache(key)
+    return entry['items']
+
+def store_cached_files(key: str, items: list) -> None:
+    """Remember the uploads sent for a key"""
+    file_id_cache[key] = {'created': time.time(), 'items': items}
+    file_id_cache.move_to_end(key)
+    save_file_id_cache(key)
+    while len(file_id_cache) > FILE_CACHE_MAX_ENTRIES:
+        evicted_key, _ = file_id_cache.popitem(last=False)
+        save_file_id_cache(evicted_key)
+
+def invalidate_cached_files(refined_url: str) -> int:
+    """Drop every cached upload for a refined URL and return how many entries were removed"""
+    keys = [key for key in file_id_cache if key == f"{refined_url}|audio" or key.startswith(f"{refined_url}|video|")]
+    for key in keys:
+        del file_id_cache[key]
+        save_file_id_cache(key)
+    return len(keys)
+
+def lookup_cached_request(refined_url: str, settings: dict):
+    """Return every cached upload needed to answer a request, or None if anything is missing"""
+    items = get_cached_files(make_cache_key(refined_url, settings))
+    if items is None:
+        return None
+    if settings['download_audio'] and not settings['audio_only']:
+        audio_items = get_cached_files(make_cache_key(refined_url, {**settings, 'audio_only': True}))
+        if audio_items is None:
+            return None
+        items = items + audio_items
+    return items
+
+def get_sent_file_id(message) -> str:
+    """Return the file_id of the file attached to a sent message"""
+    attachment = message.document or message.audio or message.effective_attachment
+    return attachment.file_id
+
+# Job journal: one row per accepted request, deleted when the job ends. Rows left behind by a crash or
+# restart are resumed on startup from the last stage they finished, recorded in their artifacts.
+job_journal_db = None
+unfinished_jobs = []
+
+def load_job_journal() -> list:
+    """Open the job journal and return the jobs the previous run didn't finish"""
+    global job_journal_db
+    try:
+        job_journal_db = open_settings_connection(JOB_JOURNAL_DB)
+        with job_journal_db:
+            job_journal_db.execute(
+                'CREATE TABLE IF NOT EXISTS jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, update_json TEXT NOT NULL, '
+                'stage TEXT NOT NULL, artifacts TEXT NOT NULL, resumes INTEGER NOT NULL DEFAULT 0, updated REAL NOT NULL)'
+            )
+        rows = job_journal_db.execute('SELECT job_id, update_json, stage, artifacts, resumes FROM jobs ORDER BY job_id').fetchall()
+        return [
+            {'job_id': job_id, 'update': json.loads(update_json), 'stage': stage, 'artifacts': json.loads(artifacts), 'resumes': resumes}
+            for job_id, update_json, stage, artifacts, resumes in rows
+        ]
+    except Exception as e:
+        logger.error(f"Error loading job journal: {e}")
+        return []
+
+def journal_add(update: Update, **artifacts):
+    """Record a new job and return its id, or None if the journal is unavailable"""
+    if job_journal_db is None:
+        return None
+    try:
+        with job_journal_db:
+            cursor = job_journal_db.execute(
+                'INSERT INTO jobs (update_json, stage, artifacts, updated) VALUES (?, ?, ?, ?)',
+                (update.to_json(), 'queued', json.dumps(artifacts), time.time())
+            )
+        return cursor.lastrowid
+    except Exception as e:
+        logger.error(f"Error writing job journal: {e}")
+        return None
+
+def journal_artifacts(job_id) -> dict:
+    """Return the artifacts recorded for a job so far"""
+    if job_id is None or job_journal_db is None:
+        return {}
+    row = job_journal_db.execute('SELECT artifacts FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+    return json.loads(row[0]) if row is not None else {}
+
+def journal_update(job_id, stage: str, **artifacts) -> None:
+    """Record that a job finished a stage, merging in the artifacts it produced"""
+    if job_id is None or job_journal_db is None:
+        return
+    try:
+        merged = {**journal_artifacts(job_id), **artifacts}
+        with job_journal_db:
+            job_journal_db.execute(
+                'UPDATE jobs SET stage = ?, artifacts = ?, updated = ? WHERE job_id = ?',
+                (stage, json.dumps(merged), time.time(), job_id)
+            )
+    except Exception as e:
+        logger.error(f"Error writing job journal: {e}")
+
+def journaled_job_dirs() -> set:
+    """Return the scratch directories of all journaled jobs"""
+    if job_journal_db is None:
+        return set()
+    rows = job_journal_db.execute('SELECT artifacts FROM jobs').fetchall()
+    return {json.loads(artifacts).get('job_dir') for artifacts, in rows} - {None}
+
+def journal_mark_resumed(job_id) -> None:
+    with job_journal_db:
+        job_journal_db.execute('UPDATE jobs SET resumes = resumes + 1 WHERE job_id = ?', (job_id,))
+
+def journal_remove(job_id) -> None:
+    """Forget a job that ended, successfully or not"""
+    if job_id is None or job_journal_db is None:
+        return
+    try:
+        with job_journal_db:
+            job_journal_db.execute('DELETE FROM jobs WHERE job_id = ?', (job_id,))
+    except Exception as e:
+        logger.error(f"Error writing job journal: {e}")
+
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as one JSON object per line"""
+
+    EXTRA_FIELDS = ('stage', 'duration', 'media_duration', 'url', 'user_id', 'bytes')
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in self.EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
 
 # Setup logging
-logging.basicConfig(filename="video_dl_bot.log", filemode='a', format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+log_handler = logging.FileHandler("video_dl_bot.log", mode='a')
+if LOG_FORMAT == 'json':
+    log_handler.setFormatter(JsonLogFormatter())
+else:
+    log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.basicConfig(handlers=[log_handler], level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+STAGE_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+
+class Metrics:
+    """Counters, gauges and histograms rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._meta = OrderedDict()  # name -> (type, help)
+        self._values = {}  # name -> {labels: value}
+        self._callbacks = {}  # name -> function returning the current gauge value
+
+    def describe(self, name: str, kind: str, help_text: str, callback=None) -> None:
+        self._meta[name] = (kind, help_text)
+        self._values.setdefault(name, {})
+        if callback is not None:
+            self._callbacks[name] = callback
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Add to a counter or gauge (use a negative value to decrease a gauge)"""
+        key = tuple(sorted(labels.items()))
+        values = self._values[name]
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Record a histogram observation"""
+        key = tuple(sorted(labels.items()))
+        values = self._values[name]
+        if key not in values:
+            values[key] = {'buckets': [0] * len(STAGE_BUCKETS), 'sum': 0.0, 'count': 0}
+        histogram = values[key]
+        for i, bound in enumerate(STAGE_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._callbacks:
+                lines.append(f"{name} {self._callbacks[name]()}")
+                continue
+            for key, value in self._values[name].items():
+                if kind == 'histogram':
+                    for bound, count in zip(STAGE_BUCKETS, value['buckets']):
+                        lines.append(f"{name}_bucket{self._labels(key + (('le', str(bound)),))} {count}")
+                    lines.append(f"{name}_bucket{self._labels(key + (('le', '+Inf'),))} {value['count']}")
+                    lines.append(f"{name}_sum{self._labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{self._labels(key)} {value['count']}")
+                else:
+                    lines.append(f"{name}{self._labels(key)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(key: tuple) -> str:
+        if not key:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in key) + '}'
+
+metrics = Metrics()
+metrics.describe('video_dl_stage_seconds', 'histogram', 'Time spent in each job stage')
+metrics.describe('video_dl_stage_failures_total', 'counter', 'Job stages that failed')
+metrics.describe('video_dl_requests_total', 'counter', 'Download requests received')
+metrics.describe('video_dl_repeat_requests_total', 'counter', 'Requests for a URL that was requested before')
+metrics.describe('video_dl_cache_hits_total', 'counter', 'Requests answered from the file_id cache')
+metrics.describe('video_dl_coalesced_requests_total', 'counter', 'Requests that waited on an identical running request')
+metrics.describe('video_dl_jobs_running', 'gauge', 'Jobs currently running', lambda: job_scheduler.running)
+metrics.describe('video_dl_jobs_queued', 'gauge', 'Jobs waiting in the queue', lambda: job_scheduler.queued)
+metrics.describe('video_dl_processes_in_flight', 'gauge', 'External processes currently running')
+metrics.describe('video_dl_processes_total', 'counter', 'External processes started')
+metrics.describe('video_dl_downloaded_bytes_total', 'counter', 'Bytes of media downloaded')
+metrics.describe('video_dl_uploaded_bytes_total', 'counter', 'Bytes of media uploaded to Telegram')
+metrics.describe('video_dl_upload_retries_total', 'counter', 'Uploads retried after a network error or flood control')
+metrics.describe('video_dl_disk_free_bytes', 'gauge', 'Free space on the downloads disk', lambda: shutil.disk_usage(SUBDIR).free)
+metrics.describe('video_dl_disk_reserved_bytes', 'gauge', 'Scratch space reserved by running jobs', lambda: storage_budget.reserved)
+metrics.describe('video_dl_ytdlp_workers', 'gauge', 'Warm yt-dlp worker processes', lambda: ytdlp_pool.workers if ytdlp_pool else 0)
+
+# Recently requested URLs, to count how often the same link is sent again
+seen_urls = OrderedDict()
+SEEN_URLS_LIMIT = 10000
+
+def record_request(refined_url: str) -> None:
+    """Count a request and whether its URL was requested before"""
+    metrics.inc('video_dl_requests_total')
+    if refined_url in seen_urls:
+        metrics.inc('video_dl_repeat_requests_total')
+        seen_urls.move_to_end(refined_url)
+    else:
+        seen_urls[refined_url] = True
+        if len(seen_urls) > SEEN_URLS_LIMIT:
+            seen_urls.popitem(last=False)
+
+@contextmanager
+def stage_timer(stage: str):
+    """Time a job stage and count it as failed if it raises"""
+    started = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        metrics.inc('video_dl_stage_failures_total', stage=stage)
+        raise
+    finally:
+        elapsed = time.monotonic() - started
+        metrics.observe('video_dl_stage_seconds', elapsed, stage=stage)
+        logger.info(f"Stage {stage} took {elapsed:.2f}s", extra={'stage': stage, 'duration': round(elapsed, 3)})
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Serve GET /metrics for Prometheus"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Skip the request headers
+        while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[1] == b'/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def post_init(application: Application) -> None:
+    """Start background services once the event loop is running"""
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Metrics endpoint listening on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    application.bot_data['sweeper'] = asyncio.ensure_future(sweep_downloads())
+    await resume_unfinished_jobs(application)
+
+async def post_shutdown(application: Application) -> None:
+    """Write anything still pending before the process exits"""
+    if 'sweeper' in application.bot_data:
+        application.bot_data['sweeper'].cancel()
+    # Interrupted jobs keep their journal entries and files and are resumed on the next start
+    for task in list(follower_tasks):
+        task.cancel()
+    await job_scheduler.shutdown()
+    if ytdlp_pool is not None:
+        ytdlp_pool.shutdown()
+    if settings_flush_task is not None and not settings_flush_task.done():
+        settings_flush_task.cancel()
+    flush_settings()
+    if file_cache_flush_task is not None and not file_cache_flush_task.done():
+        file_cache_flush_task.cancel()
+    flush_file_id_cache()
+
 async def start(update: Update, context: CallbackContext) -> None:
     await update.message.reply_text(
         'Hi! Send me a video URL to download.\n\n'
         'Commands:\n'
         '/settings - Configure download options\n'
         '/set_proxy URL - Set proxy server\n'
-        '/set_cookies BROWSER - Use browser cookies for auth'
+        '/set_cookies BROWSER - Use browser cookies for auth\n'
+        '/refresh URL - Download a link again instead of reusing the cached copy'
     )
 
 async def settings_command(update: Update, context: CallbackContext) -> None:
@@ -115,6 +680,10 @@ async def get_settings_keyboard(user_id: int) -> list:
             f"{'✅' if settings['force_ipv4'] else '❌'} Force IPv4",
             callback_data='toggle_ipv4'
         )],
+        [InlineKeyboardButton(
+            f"{'✅' if settings['expand_playlists'] else '❌'} Download Playlists",
+            callback_data='toggle_playlists'
+        )],
         [InlineKeyboardButton(
             f"🌐 Proxy: {settings['proxy_url']}",
             callback_data='show_proxy_info'
@@ -150,6 +719,8 @@ async def settings_button(update: Update, context: CallbackContext) -> None:
         settings['use_aria2'] = not settings['use_aria2']
     elif query.data == 'toggle_ipv4':
         settings['force_ipv4'] = not settings['force_ipv4']
+    elif query.data == 'toggle_playlists':
+        settings['expand_playlists'] = not settings['expand_playlists']
     elif query.data == 'show_proxy_info':
         await query.answer(
             f"Current proxy: {settings['proxy_url']}\n"
@@ -166,7 +737,7 @@ async def settings_button(update: Update, context: CallbackContext) -> None:
         )
         return
 
-    save_settings()
+    save_settings(user_id)
 
     # Update the keyboard
     keyboard = await get_settings_keyboard(update.effective_user.id)
@@ -193,7 +764,7 @@ async def set_proxy_command(update: Update, context: CallbackContext) -> None:
         settings['proxy_url'] = proxy_url
         await update.message.reply_text(f"Proxy set to: {proxy_url}")
 
-    save_settings()
+    save_settings(update.effective_user.id)
 
 async def set_cookies_command(update: Update, context: CallbackContext) -> None:
     """Handle the cookies browser setting command"""
@@ -222,7 +793,23 @@ async def set_cookies_command(update: Update, context: CallbackContext) -> None:
         settings['cookies_browser'] = browser
         await update.message.reply_text(f"Cookies browser set to: {browser}")
 
-    save_settings()
+    save_settings(update.effective_user.id)
+
+async def refresh_command(update: Update, context: CallbackContext) -> None:
+    """Handle the command that forgets cached uploads for a URL"""
+    if not context.args:
+        await update.message.reply_text(
+            "Please provide the URL to download again next time.\n"
+            "Example: /refresh https://www.youtube.com/watch?v=..."
+        )
+        return
+
+    refined_url, _ = await refine_url_and_filename(context.args[0])
+    removed = invalidate_cached_files(refined_url)
+    if removed:
+        await update.message.reply_text(f"Cleared cached files for: {refined_url}")
+    else:
+        await update.message.reply_text(f"No cached files for: {refined_url}")
 
 async def refine_url_and_filename(url: str) -> tuple:
     refined_url = url.split('?')[0]
@@ -284,17 +871,63 @@ def build_ytdlp_base_options(settings: dict) -> list:
 
     return options
 
-def build_video_command(url: str, output_path: str, settings: dict) -> list:
-    """Build yt-dlp command for video download with improved success rate."""
-    cmd = ['yt-dlp']
+OUTPUT_PATH_MARKER = 'video-dl-bot-output:'
+
+def build_output_path_options() -> list:
+    """Make yt-dlp print the final path of every file it writes, after post-processing"""
+    return [
+        '--print', f'after_move:{OUTPUT_PATH_MARKER}%(filepath)s',
+        # --print implies --quiet, keep the progress lines for the progress tracker
+        '--progress',
+    ]
+
+def parse_output_paths(stdout: str) -> list:
+    """Return the output paths reported by yt-dlp, in order"""
+    return [
+        line[len(OUTPUT_PATH_MARKER):].strip()
+        for line in stdout.splitlines()
+        if line.startswith(OUTPUT_PATH_MARKER) and os.path.isfile(line[len(OUTPUT_PATH_MARKER):].strip())
+    ]
+
+def create_job_dir() -> str:
+    """Create a scratch directory for one job"""
+    os.makedirs(SUBDIR, exist_ok=True)
+    job_dir = tempfile.mkdtemp(prefix='job_', dir=os.path.abspath(SUBDIR))
+    if LOCAL_BOT_API:
+        # The Bot API server may run as another user and needs to read the files
+        os.chmod(job_dir, 0o755)
+    return job_dir
+
+def remove_stale_job_dirs(keep: set = frozenset()) -> None:
+    """Remove scratch directories left behind by a previous run, except those of jobs being resumed"""
+    keep = {os.path.abspath(job_dir) for job_dir in keep if job_dir}
+    for job_dir in glob.glob(os.path.join(SUBDIR, 'job_*')):
+        if os.path.abspath(job_dir) in keep:
+            continue
+        logger.info(f"Removing leftover job directory {job_dir}")
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+# Improved format selection with fallbacks
+# Priority: h264 video + best audio, then any video + audio, then best available
+VIDEO_FORMAT_SELECTION = (
+    'bestvideo[vcodec^=avc1][height<=1080]+bestaudio[acodec^=mp4a]/bestvideo[vcodec^=avc1]+bestaudio/'
+    'bestvideo[height<=1080]+bestaudio/bestvideo+bestaudio/best[height<=1080]/best'
+)
+
+def build_video_command(url: str, output_path: str, settings: dict, format_selection: str = None, info_json_path: str = None) -> list:
+    """Build yt-dlp command for video download with improved success rate.
+
+    `format_selection` overrides the default format fallbacks, and `info_json_path`
+    downloads from previously probed metadata instead of extracting the URL again.
+    """
+    cmd = [YTDLP_BIN]
     cmd.extend(build_ytdlp_base_options(settings))
 
-    # Improved format selection with fallbacks
-    # Priority: h264 video + best audio, then any video + audio, then best available
-    format_selection = (
-        'bestvideo[vcodec^=avc1][height<=1080]+bestaudio[acodec^=mp4a]/bestvideo[vcodec^=avc1]+bestaudio/'
-        'bestvideo[height<=1080]+bestaudio/bestvideo+bestaudio/best[height<=1080]/best'
-    )
+    if format_selection:
+        # Fall back to the usual selection if the chosen formats are unavailable
+        format_selection = f'{format_selection}/{VIDEO_FORMAT_SELECTION}'
+    else:
+        format_selection = VIDEO_FORMAT_SELECTION
     cmd.extend(['-f', format_selection])
 
     # Output format and path
@@ -302,166 +935,1762 @@ def build_video_command(url: str, output_path: str, settings: dict) -> list:
         '--merge-output-format', 'mp4',
         '-o', f'{output_path}.%(ext)s'
     ])
+    cmd.extend(build_output_path_options())
 
-    cmd.append(url)
+    if info_json_path:
+        cmd.extend(['--load-info-json', info_json_path])
+    else:
+        cmd.append(url)
     return cmd
 
-def build_audio_command(url: str, output_path: str, settings: dict) -> list:
-    """Build yt-dlp command for audio-only download with improved success rate."""
-    cmd = ['yt-dlp']
+def build_audio_command(url: str, output_path: str, settings: dict, info_json_path: str = None) -> list:
+    """Build yt-dlp command for audio-only download with improved success rate.
+
+    `info_json_path` downloads from previously read metadata instead of extracting the URL again.
+    """
+    cmd = [YTDLP_BIN]
     cmd.extend(build_ytdlp_base_options(settings))
 
-    # Audio extraction options
+    # Audio extraction options; with 'best' the audio is kept as downloaded, preferring m4a
+    if AUDIO_FORMAT == 'best':
+        cmd.extend(['-f', 'bestaudio[ext=m4a]/bestaudio/best'])
     cmd.extend([
         '-x',
-        '--audio-format', 'mp3',
-        '--audio-quality', '0',  # Best quality
+        '--audio-format', AUDIO_FORMAT,
+        '--audio-quality', '0',  # Best quality when converting
         '-o', f'{output_path}.%(ext)s'
     ])
+    cmd.extend(build_output_path_options())
 
-    cmd.append(url)
+    if info_json_path:
+        cmd.extend(['--load-info-json', info_json_path])
+    else:
+        cmd.append(url)
     return cmd
 
-def run_ytdlp_command(cmd: list) -> tuple:
-    """Run yt-dlp command and return (success, stdout, stderr)."""
+async def _read_stream(stream: asyncio.StreamReader, buffer: deque, limit: int, on_line=None) -> None:
+    """Read a process stream line by line, keeping only the last `limit` characters."""
+    size = 0
+    pending = ''
+    while True:
+        chunk = await stream.read(4096)
+        if not chunk:
+            break
+        # ffmpeg and yt-dlp redraw status lines with '\r', so treat it as a line break too
+        pending += chunk.decode(errors='replace').replace('\r', '\n')
+        *lines, pending = pending.split('\n')
+        if len(pending) > limit:
+            lines.append(pending)
+            pending = ''
+        for line in lines:
+            buffer.append(line + '\n')
+            size += len(line) + 1
+            while size > limit and len(buffer) > 1:
+                size -= len(buffer.popleft())
+            if on_line is not None:
+                on_line(line)
+    if pending:
+        buffer.append(pending)
+        if on_line is not None:
+            on_line(pending)
+
+class ProcessStalledError(Exception):
+    """Raised when a process watchdog reports that a command stopped making progress."""
+
+async def run_process(cmd: list, timeout: float = PROCESS_TIMEOUT, on_line=None, watchdog=None, output_limit: int = None) -> tuple:
+    """Run an external command without blocking the event loop.
+
+    Returns (returncode, stdout, stderr). Output is streamed as it is produced;
+    `on_line` is called for every stdout and stderr line, and only the last
+    `output_limit` characters of each stream are kept. Raises asyncio.TimeoutError
+    if the command runs longer than `timeout` seconds (None for no limit). `watchdog` is polled every
+    second and the command is killed with ProcessStalledError once it returns True.
+    The process is killed on timeout and when the calling task is cancelled.
+    """
+    tool = os.path.basename(cmd[0])
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    metrics.inc('video_dl_processes_total', tool=tool)
+    metrics.inc('video_dl_processes_in_flight', tool=tool)
+    stdout, stderr = deque(), deque()
+    output_limit = output_limit or PROCESS_OUTPUT_LIMIT
+    stalled = False
+
+    async def watch() -> None:
+        nonlocal stalled
+        while process.returncode is None:
+            await asyncio.sleep(1)
+            if process.returncode is None and watchdog():
+                stalled = True
+                process.kill()
+                return
+
+    watcher = asyncio.ensure_future(watch()) if watchdog is not None else None
     try:
-        result = subprocess.run(
-            cmd,
-            check=False,  # Don't raise exception, we'll check returncode
-            text=True,
-            capture_output=True,
-            timeout=600  # 10 minute timeout
-        )
+        await asyncio.wait_for(asyncio.gather(
+            _read_stream(process.stdout, stdout, output_limit, on_line),
+            _read_stream(process.stderr, stderr, output_limit, on_line),
+            process.wait()
+        ), timeout=timeout)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        metrics.inc('video_dl_processes_in_flight', -1, tool=tool)
+    if stalled:
+        raise ProcessStalledError(f"{tool} made no progress and was stopped")
+    return process.returncode, ''.join(stdout), ''.join(stderr)
+
+async def check_process(cmd: list, timeout: float = PROCESS_TIMEOUT, on_line=None, watchdog=None, output_limit: int = None) -> str:
+    """Run an external command and return its stdout, raising CalledProcessError on failure."""
+    returncode, stdout, stderr = await run_process(cmd, timeout=timeout, on_line=on_line, watchdog=watchdog, output_limit=output_limit)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+    return stdout
+
+class WorkerOutput(io.TextIOBase):
+    """stdout or stderr of a yt-dlp worker, sent to the pool line by line"""
+
+    def __init__(self, connection, stream: str):
+        self.connection = connection
+        self.stream = stream
+        self._pending = ''
+
+    def write(self, text: str) -> int:
+        # yt-dlp redraws status lines with '\r', so treat it as a line break too
+        self._pending += text.replace('\r', '\n')
+        *lines, self._pending = self._pending.split('\n')
+        for line in lines:
+            self.connection.send(('line', self.stream, line))
+        return len(text)
+
+    def close(self) -> None:
+        if self._pending:
+            self.connection.send(('line', self.stream, self._pending))
+            self._pending = ''
+
+def ytdlp_worker_main(connection) -> None:
+    """Entry point of a yt-dlp worker process: run the command lines sent by the pool until it disconnects.
+
+    Extractors and cookie jars are kept between jobs, so logins, extractor caches and browser
+    cookies are only set up once per worker.
+    """
+    import yt_dlp
+    from yt_dlp.utils import DownloadError, expand_path
+
+    # Ctrl+C is handled by the bot, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    extractors = {}
+    cookiejars = {}
+
+    class WarmYoutubeDL(yt_dlp.YoutubeDL):
+        def get_info_extractor(self, ie_key):
+            if ie_key not in extractors:
+                extractors[ie_key] = super().get_info_extractor(ie_key)
+            extractors[ie_key].set_downloader(self)
+            return extractors[ie_key]
+
+        @functools.cached_property
+        def cookiejar(self):
+            key = (self.params.get('cookiefile'), repr(self.params.get('cookiesfrombrowser')))
+            if key not in cookiejars:
+                cookiejars[key] = super().cookiejar
+            return cookiejars[key]
+
+    while True:
+        try:
+            args = connection.recv()
+        except EOFError:
+            return
+        stdout, stderr = WorkerOutput(connection, 'stdout'), WorkerOutput(connection, 'stderr')
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            try:
+                parsed = yt_dlp.parse_options(args)
+                with WarmYoutubeDL(parsed.ydl_opts) as ydl:
+                    if parsed.options.load_info_filename is not None:
+                        returncode = ydl.download_with_info_file(expand_path(parsed.options.load_info_filename))
+                    else:
+                        returncode = ydl.download(parsed.urls)
+            except SystemExit as e:
+                # Invalid options, already reported by the option parser
+                returncode = e.code if isinstance(e.code, int) else 2
+            except Exception as e:
+                if not isinstance(e, DownloadError):
+                    print(f"ERROR: {e}", file=sys.stderr)
+                returncode = 1
+        stdout.close()
+        stderr.close()
+        connection.send(('exit', returncode))
+
+class YtdlpWorker:
+    """A worker process that runs yt-dlp jobs one at a time"""
+
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=ytdlp_worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.jobs = 0
+
+    def stop(self, kill: bool = False) -> None:
+        if kill:
+            # A job may be reading from the connection, it ends when the process is gone
+            self.process.kill()
+        else:
+            self.connection.close()
+
+class YtdlpPool:
+    """Warm worker processes that run yt-dlp as a library, instead of a new yt-dlp process per job.
+
+    A worker only serves jobs with the same base options (proxy, cookies, IPv4...), so extractor
+    state and cookies aren't shared between option sets. Workers are replaced after `max_jobs`
+    jobs, and killed when their job is cancelled, times out or stalls, like run_process does.
+    """
+
+    def __init__(self, max_workers: int, max_jobs: int):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self._idle = OrderedDict()  # worker -> options key, least recently used first
+        self._workers = 0  # Started and not retired
+        self._waiters = deque()  # Futures of jobs waiting for a worker slot
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._context = multiprocessing.get_context(start_method)
+        # Workers are forked from a server that already imported yt-dlp
+        self._context.set_forkserver_preload(['yt_dlp'])
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    async def run(self, key: tuple, args: list, timeout: float = PROCESS_TIMEOUT, on_line=None, watchdog=None, output_limit: int = None) -> tuple:
+        """Run yt-dlp with command line arguments `args` in a worker for the options `key`.
+
+        Takes the same arguments and returns the same (returncode, stdout, stderr) as run_process.
+        """
+        worker = await self._acquire(key)
+        loop = asyncio.get_running_loop()
+        output = {'stdout': deque(), 'stderr': deque()}
+        sizes = {'stdout': 0, 'stderr': 0}
+        output_limit = output_limit or PROCESS_OUTPUT_LIMIT
+
+        async def communicate():
+            worker.connection.send(list(args))
+            while True:
+                try:
+                    message = await loop.run_in_executor(None, worker.connection.recv)
+                except (EOFError, OSError):
+                    # The worker died or was killed
+                    return None
+                if message[0] == 'exit':
+                    return message[1]
+                _, stream, line = message
+                output[stream].append(line + '\n')
+                sizes[stream] += len(line) + 1
+                while sizes[stream] > output_limit and len(output[stream]) > 1:
+                    sizes[stream] -= len(output[stream].popleft())
+                if on_line is not None:
+                    on_line(line)
+
+        async def watch() -> None:
+            while not watchdog():
+                await asyncio.sleep(1)
+
+        job = asyncio.ensure_future(communicate())
+        watcher = asyncio.ensure_future(watch()) if watchdog is not None else None
+        returncode = None
+        metrics.inc('video_dl_processes_in_flight', tool='yt-dlp-worker')
+        try:
+            done, _ = await asyncio.wait([task for task in (job, watcher) if task is not None], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if job not in done:
+                if watcher is not None and watcher in done:
+                    raise ProcessStalledError("yt-dlp made no progress and was stopped")
+                raise asyncio.TimeoutError()
+            returncode = job.result()
+        finally:
+            for task in (job, watcher):
+                if task is not None:
+                    task.cancel()
+            metrics.inc('video_dl_processes_in_flight', -1, tool='yt-dlp-worker')
+            self._release(worker, key, returncode is not None)
+
+        stderr = ''.join(output['stderr'])
+        if returncode is None:
+            returncode, stderr = -1, stderr + 'ERROR: The yt-dlp worker exited unexpectedly\n'
+        return returncode, ''.join(output['stdout']), stderr
+
+    async def _acquire(self, key: tuple) -> YtdlpWorker:
+        while True:
+            worker = next((worker for worker, worker_key in self._idle.items() if worker_key == key), None)
+            if worker is not None:
+                del self._idle[worker]
+                break
+            if self._workers >= self.max_workers and self._idle:
+                # Make room by retiring the least recently used idle worker of another option set
+                oldest = next(iter(self._idle))
+                del self._idle[oldest]
+                self._retire(oldest)
+            if self._workers < self.max_workers:
+                self._workers += 1
+                try:
+                    worker = await asyncio.get_running_loop().run_in_executor(None, YtdlpWorker, self._context)
+                except BaseException:
+                    self._workers -= 1
+                    self._wake()
+                    raise
+                break
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        worker.jobs += 1
+        return worker
+
+    def _release(self, worker: YtdlpWorker, key: tuple, reusable: bool) -> None:
+        if reusable and worker.jobs < self.max_jobs:
+            self._idle[worker] = key
+        else:
+            self._retire(worker, kill=not reusable)
+        self._wake()
+
+    def _retire(self, worker: YtdlpWorker, kill: bool = False) -> None:
+        worker.stop(kill)
+        self._workers -= 1
+
+    def _wake(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def shutdown(self) -> None:
+        """Stop the idle workers; busy ones are killed when their jobs are cancelled"""
+        while self._idle:
+            worker, _ = self._idle.popitem()
+            self._retire(worker)
+
+ytdlp_pool = None
+if YTDLP_IN_PROCESS:
+    if importlib.util.find_spec('yt_dlp') is not None:
+        ytdlp_pool = YtdlpPool(DOWNLOAD_WORKERS, YTDLP_WORKER_JOBS)
+    else:
+        logger.warning("The yt_dlp package isn't installed, running the yt-dlp command for every job instead")
+
+async def run_ytdlp(cmd: list, settings: dict, timeout: float = PROCESS_TIMEOUT, on_line=None, watchdog=None, output_limit: int = None) -> tuple:
+    """Run a yt-dlp command line in a warm worker, or as a process if the pool is disabled.
+
+    Takes the same arguments and returns the same (returncode, stdout, stderr) as run_process.
+    """
+    if ytdlp_pool is None:
+        return await run_process(cmd, timeout=timeout, on_line=on_line, watchdog=watchdog, output_limit=output_limit)
+    key = tuple(build_ytdlp_base_options(settings))
+    return await ytdlp_pool.run(key, cmd[1:], timeout=timeout, on_line=on_line, watchdog=watchdog, output_limit=output_limit)
+
+async def run_ytdlp_command(cmd: list, settings: dict, progress=None) -> tuple:
+    """Run yt-dlp command and return (success, stdout, stderr).
+
+    If a ProgressTracker is given, download progress is fed to it and the
+    download is stopped when it stalls.
+    """
+    try:
+        if progress is not None:
+            returncode, stdout, stderr = await run_ytdlp(cmd, settings, on_line=progress.feed_ytdlp, watchdog=progress.stalled)
+        else:
+            returncode, stdout, stderr = await run_ytdlp(cmd, settings)
 
         # yt-dlp returns 0 on success, non-zero on failure
-        success = result.returncode == 0
+        success = returncode == 0
 
-        return success, result.stdout, result.stderr
-    except subprocess.TimeoutExpired:
-        return False, '', 'Download timed out after 10 minutes'
+        return success, stdout, stderr
+    except asyncio.TimeoutError:
+        return False, '', f'Download timed out after {PROCESS_TIMEOUT // 60} minutes'
+    except ProcessStalledError:
+        return False, '', f'ERROR: Download stalled for {STALL_TIMEOUT} seconds and was stopped'
     except Exception as e:
         return False, '', str(e)
 
-async def compress_video(file_path: str) -> str:
-    """Compress video using ffmpeg and return the path to compressed file."""
+SIZE_UNITS = {
+    'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3, 'TiB': 1024 ** 4,
+    'KB': 1000, 'MB': 1000 ** 2, 'GB': 1000 ** 3, 'TB': 1000 ** 4,
+}
+YTDLP_PROGRESS_RE = re.compile(
+    r'^\[download\]\s+(?P<percent>[\d.]+)%\s+of\s+~?\s*(?P<total>[\d.]+)(?P<total_unit>[KMGT]?i?B)'
+    r'(?:\s+at\s+(?:(?P<speed>[\d.]+)(?P<speed_unit>[KMGT]?i?B)/s|Unknown speed))?'
+    r'(?:\s+ETA\s+(?P<eta>[\d:]+))?'
+)
+
+def parse_size(value: str, unit: str) -> int:
+    """Convert a yt-dlp size like ('12.5', 'MiB') to bytes"""
+    return int(float(value) * SIZE_UNITS.get(unit, 1))
+
+def format_duration(seconds: float) -> str:
+    """Format seconds as M:SS or H:MM:SS"""
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+# Trackers of jobs currently running, for anything that needs their speed, ETA or byte counts
+active_trackers = set()
+
+class ProgressTracker:
+    """Progress of one job, parsed from yt-dlp --newline and ffmpeg -progress output.
+
+    `on_change` is called with the rendered status text whenever the numbers change.
+    """
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.stage = 'Starting'
+        self.percent = None
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.speed = None  # Bytes per second while downloading, encode speed factor while transcoding
+        self.eta = None  # Seconds
+        self.duration = None  # Media duration of the current ffmpeg stage
+        self.downloading = False
+        self.last_advance = time.monotonic()
+
+    def set_stage(self, stage: str, duration: float = None) -> None:
+        """Start a new stage, e.g. 'Downloading' or 'Compressing'"""
+        self.stage = stage
+        self.duration = duration
+        self.percent = None
+        self.speed = None
+        self.eta = None
+        self.downloading = False
+        self.last_advance = time.monotonic()
+        self._changed()
+
+    def feed_ytdlp(self, line: str) -> None:
+        """Parse a line of yt-dlp output"""
+        match = YTDLP_PROGRESS_RE.match(line.strip())
+        if match is None:
+            # Destination, merger and post-processing lines: the download isn't stalled
+            self.downloading = False
+            self.last_advance = time.monotonic()
+            return
+
+        percent = float(match['percent'])
+        total_bytes = parse_size(match['total'], match['total_unit'])
+        downloaded_bytes = int(total_bytes * percent / 100)
+        if downloaded_bytes > self.downloaded_bytes or not self.downloading or total_bytes != self.total_bytes:
+            self.last_advance = time.monotonic()
+        self.downloading = percent < 100
+        self.percent = percent
+        self.total_bytes = total_bytes
+        self.downloaded_bytes = downloaded_bytes
+        self.speed = parse_size(match['speed'], match['speed_unit']) if match['speed'] else None
+        self.eta = None
+        if match['eta']:
+            self.eta = 0
+            for part in match['eta'].split(':'):
+                self.eta = self.eta * 60 + int(part)
+        self._changed()
+
+    def feed_ffmpeg(self, line: str) -> None:
+        """Parse a key=value line of ffmpeg -progress output"""
+        key, _, value = line.strip().partition('=')
+        if key == 'out_time_us' and value.isdigit() and self.duration:
+            self.percent = min(100.0, int(value) / 1e6 / self.duration * 100)
+            self.last_advance = time.monotonic()
+        elif key == 'speed' and value.endswith('x'):
+            try:
+                self.speed = float(value[:-1])
+            except ValueError:
+                self.speed = None
+        elif key == 'progress':
+            # ffmpeg reports a block of keys per update and ends each with progress=...
+            if self.percent is not None and self.speed and self.duration:
+                self.eta = (100 - self.percent) / 100 * self.duration / self.speed
+            self._changed()
+
+    def set_percent(self, percent: float) -> None:
+        """Report progress of a stage that isn't parsed from process output"""
+        self.percent = percent
+        self.last_advance = time.monotonic()
+        self._changed()
+
+    def stalled(self) -> bool:
+        """True if a download is running but hasn't advanced for STALL_TIMEOUT seconds"""
+        return self.downloading and time.monotonic() - self.last_advance > STALL_TIMEOUT
+
+    def render(self) -> str:
+        """Render the progress as a one-line status"""
+        if self.percent is None:
+            return f"{self.stage}..."
+        text = f"{self.stage}: {self.percent:.1f}%"
+        if self.downloading or self.stage == 'Downloading':
+            if self.total_bytes:
+                text += f" of {self.total_bytes / MB_IN_BYTES:.1f} MB"
+            if self.speed:
+                text += f" at {self.speed / MB_IN_BYTES:.2f} MB/s"
+        elif self.speed:
+            text += f" at {self.speed:.2f}x"
+        if self.eta is not None:
+            text += f", ETA {format_duration(self.eta)}"
+        return text
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change(self.render())
+
+class StatusMessage:
+    """A single chat message that is edited to show job status.
+
+    Edits are throttled to one per PROGRESS_UPDATE_INTERVAL seconds; updates arriving
+    in between are coalesced so only the latest text is sent.
+    """
+
+    def __init__(self, message, header: str):
+        self.message = message
+        self.header = header
+        self._text = message.text
+        self._pending = None
+        self._next_edit = time.monotonic() + PROGRESS_UPDATE_INTERVAL
+        self._task = None
+
+    def set(self, status: str) -> None:
+        """Show a new status line under the header"""
+        text = f"{self.header}\n{status}"
+        if text == self._text:
+            self._pending = None
+            return
+        self._pending = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._flush())
+
+    async def close(self) -> None:
+        """Wait for the last pending edit to be sent"""
+        if self._task is not None:
+            await self._task
+
+    async def _flush(self) -> None:
+        while self._pending is not None:
+            delay = self._next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text, self._pending = self._pending, None
+            if text is None or text == self._text:
+                continue
+            self._next_edit = time.monotonic() + PROGRESS_UPDATE_INTERVAL
+            try:
+                await self.message.edit_text(text)
+                self._text = text
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self._next_edit = time.monotonic() + retry_after
+                if self._pending is None:
+                    self._pending = text
+            except BadRequest as e:
+                # "Message is not modified" and deleted messages aren't worth retrying
+                logger.debug(f"Status message not updated: {e}")
+            except TelegramError as e:
+                logger.warning(f"Failed to update status message: {e}")
+
+def plan_target_bitrate(duration: float, size_limit_mb: float):
+    """Return the video bitrate in kbps that fits `duration` seconds into `size_limit_mb`,
+    or None if the bitrate would be too low to be watchable."""
+    if duration <= 0:
+        return None
+    total_kbps = size_limit_mb * MB_IN_BYTES * 8 * COMPRESS_SIZE_MARGIN / 1000 / duration
+    video_kbps = int(total_kbps - COMPRESS_AUDIO_BITRATE_KBPS)
+    if video_kbps < COMPRESS_MIN_VIDEO_BITRATE_KBPS:
+        return None
+    return video_kbps
+
+def get_encode_profile() -> dict:
+    """Return the configured encoder profile with any overrides applied"""
+    if ENCODE_PROFILE not in ENCODE_PROFILES:
+        logger.warning(f"Unknown ENCODE_PROFILE {ENCODE_PROFILE}, using x264")
+    profile = dict(ENCODE_PROFILES.get(ENCODE_PROFILE, ENCODE_PROFILES['x264']))
+    if ENCODE_CODEC:
+        profile['codec'] = ENCODE_CODEC
+    if ENCODE_PRESET:
+        profile['preset'] = ENCODE_PRESET
+    return profile
+
+def build_video_encode_options(profile: dict, video_bitrate_kbps: int, threads: int = 0) -> list:
+    """Build ffmpeg video encoding options for a profile and target bitrate"""
+    options = ['-c:v', profile['codec']]
+    if profile['preset']:
+        options.extend(['-preset', profile['preset']])
+    options.extend(profile['options'])
+    options.extend([
+        '-b:v', f'{video_bitrate_kbps}k',
+        '-maxrate', f'{int(video_bitrate_kbps * 1.5)}k', '-bufsize', f'{video_bitrate_kbps * 2}k'
+    ])
+    if threads:
+        options.extend(['-threads', str(threads)])
+    if COMPRESS_MAX_HEIGHT:
+        options.extend(['-vf', f"scale=-2:'min(ih,{COMPRESS_MAX_HEIGHT})'"])
+    return options
+
+def build_pass_options(profile: dict, pass_number: int, passlog: str) -> list:
+    """Build the ffmpeg options for one pass of a two-pass encode"""
+    if profile['codec'] == 'libx265':
+        # libx265 ignores -pass and -passlogfile and writes its own stats file
+        return ['-x265-params', f'pass={pass_number}:stats={passlog}.x265']
+    return ['-pass', str(pass_number), '-passlogfile', passlog]
+
+async def probe_streams(file_path: str) -> list:
+    """Return the streams of a media file as reported by ffprobe"""
+    with stage_timer('ffprobe'):
+        output = await check_process([
+            'ffprobe', '-v', 'error', '-show_entries', 'stream=index,codec_type,codec_name',
+            '-of', 'json', file_path
+        ], timeout=60)
+    return json.loads(output).get('streams', [])
+
+async def remux_video(file_path: str) -> str:
+    """Stream-copy the first video and audio track into a faststart MP4, dropping any other tracks.
+
+    Replaces the original and returns the new path if that made the file smaller, otherwise returns None.
+    """
+    streams = await probe_streams(file_path)
+    video_streams = [stream for stream in streams if stream.get('codec_type') == 'video']
+    audio_streams = [stream for stream in streams if stream.get('codec_type') == 'audio']
+    kept_streams = video_streams[:1] + audio_streams[:1]
+    if not video_streams or (len(kept_streams) == len(streams) and file_path.endswith('.mp4')):
+        return None
+    if any(stream.get('codec_name') not in MP4_COPY_CODECS for stream in kept_streams):
+        logger.info(f"Can't remux {file_path}: {[stream.get('codec_name') for stream in kept_streams]} need re-encoding for MP4")
+        return None
+
+    base_path = os.path.splitext(file_path)[0]
+    remuxed_path = f"{base_path}.remux.mp4"
+    try:
+        with stage_timer('remux'):
+            await check_process([
+                'ffmpeg', '-y', '-nostats', '-v', 'error', '-i', file_path,
+                '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy', '-movflags', 'faststart', remuxed_path
+            ], timeout=None)
+    except Exception as e:
+        logger.warning(f"Remuxing {file_path} failed: {e}")
+        if os.path.exists(remuxed_path):
+            os.remove(remuxed_path)
+        return None
+
+    if os.path.getsize(remuxed_path) >= os.path.getsize(file_path):
+        os.remove(remuxed_path)
+        return None
+    os.remove(file_path)
+    os.replace(remuxed_path, f"{base_path}.mp4")
+    logger.info(f"Remuxed {file_path} to {base_path}.mp4, dropping {len(streams) - len(kept_streams)} tracks")
+    return f"{base_path}.mp4"
+
+async def run_all(coroutines: list) -> None:
+    """Run coroutines concurrently; if one fails, cancel the rest (which kills their processes)"""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def compress_video(file_path: str, video_bitrate_kbps: int, progress=None, duration: float = None) -> str:
+    """Compress video to a target bitrate using ffmpeg and return the path to compressed file.
+
+    If a ProgressTracker with the video duration is given, encoding progress is fed to it.
+    Long videos are encoded in parallel chunks when CHUNKED_ENCODING is enabled.
+    """
     compressed_path = f"{file_path}_compressed.mp4"
-    command = f"ffmpeg -i {shlex.quote(file_path)} -c:v libx264 -tag:v avc1 -movflags faststart -crf 30 -preset superfast {shlex.quote(compressed_path)}"
-    
+    profile = get_encode_profile()
+    two_pass = COMPRESS_TWO_PASS and profile['two_pass']
+    # Inside the job directory, so the path has no ':' that would break -x265-params
+    passlog = os.path.join(os.path.dirname(file_path), 'passlog')
+    audio_options = ['-c:a', 'aac', '-b:a', f'{COMPRESS_AUDIO_BITRATE_KBPS}k']
+
     try:
-        subprocess.run(command, shell=True, check=True, text=True, capture_output=True)
-        logger.info(f"Video compressed successfully to {compressed_path}")
+        async with job_scheduler.stage('transcode'):
+            with stage_timer('compress'):
+                if CHUNKED_ENCODING and duration and duration >= CHUNKED_ENCODING_MIN_DURATION:
+                    await compress_video_chunked(file_path, compressed_path, profile, video_bitrate_kbps, audio_options, progress)
+                else:
+                    video_options = build_video_encode_options(profile, video_bitrate_kbps, ENCODE_THREADS)
+                    commands = []
+                    if two_pass:
+                        commands.append(['ffmpeg', '-y', '-i', file_path, *video_options, *build_pass_options(profile, 1, passlog), '-an', '-f', 'null', os.devnull])
+                        commands.append(['ffmpeg', '-y', '-i', file_path, *video_options, *build_pass_options(profile, 2, passlog), *audio_options, '-movflags', 'faststart', compressed_path])
+                    else:
+                        commands.append(['ffmpeg', '-y', '-i', file_path, *video_options, *audio_options, '-movflags', 'faststart', compressed_path])
+
+                    for i, command in enumerate(commands):
+                        if progress is None:
+                            await check_process(command, timeout=None)
+                            continue
+                        stage = f"Compressing (pass {i + 1}/{len(commands)})" if len(commands) > 1 else "Compressing"
+                        progress.set_stage(stage, progress.duration)
+                        await check_process(command[:1] + ['-nostats', '-progress', 'pipe:1'] + command[1:], timeout=None, on_line=progress.feed_ffmpeg)
+        logger.info(f"Video compressed successfully to {compressed_path} at {video_bitrate_kbps} kbps with {profile['codec']}")
         return compressed_path
     except Exception as e:
         logger.error(f"Failed to compress video: {str(e)}")
+        if os.path.exists(compressed_path):
+            os.remove(compressed_path)
         raise
+    finally:
+        if two_pass:
+            for suffix in ('-0.log', '-0.log.mbtree', '.x265', '.x265.cutree'):
+                if os.path.exists(passlog + suffix):
+                    os.remove(passlog + suffix)
+
+async def compress_video_chunked(file_path: str, compressed_path: str, profile: dict, video_bitrate_kbps: int, audio_options: list, progress=None) -> None:
+    """Encode a video as keyframe-aligned chunks in parallel and join them losslessly.
+
+    The video stream is cut with stream copy, each chunk is encoded by its own ffmpeg
+    process (single pass, the same bitrate everywhere), the audio is encoded once, and
+    the result is joined with the concat demuxer without re-encoding.
+    """
+    chunk_dir = f"{file_path}_chunks"
+    os.makedirs(chunk_dir, exist_ok=True)
+    threads = ENCODE_THREADS or max(1, (os.cpu_count() or 1) // ENCODE_CHUNK_WORKERS)
+    video_options = build_video_encode_options(profile, video_bitrate_kbps, threads)
+    try:
+        await check_process([
+            'ffmpeg', '-y', '-nostats', '-v', 'error', '-i', file_path, '-map', '0:v:0', '-c', 'copy',
+            '-f', 'segment', '-segment_time', str(ENCODE_CHUNK_DURATION), '-reset_timestamps', '1',
+            os.path.join(chunk_dir, 'chunk_%04d.mkv')
+        ], timeout=None)
+        chunks = sorted(glob.glob(os.path.join(chunk_dir, 'chunk_*.mkv')))
+        encoded_chunks = [os.path.join(chunk_dir, f'encoded_{i:04d}.mp4') for i in range(len(chunks))]
+        logger.info(f"Encoding {file_path} as {len(chunks)} chunks, {ENCODE_CHUNK_WORKERS} at a time")
+
+        if progress is not None:
+            progress.set_stage(f"Compressing ({len(chunks)} chunks)")
+        semaphore = asyncio.Semaphore(ENCODE_CHUNK_WORKERS)
+        finished = 0
+
+        async def encode_chunk(chunk: str, encoded_chunk: str) -> None:
+            nonlocal finished
+            async with semaphore:
+                await check_process(['ffmpeg', '-y', '-nostats', '-v', 'error', '-i', chunk, *video_options, '-an', encoded_chunk], timeout=None)
+            os.remove(chunk)
+            finished += 1
+            if progress is not None:
+                progress.set_percent(finished / len(chunks) * 100)
+
+        # Probe before creating the encode coroutines, so none is left unawaited if ffprobe fails
+        has_audio = any(stream.get('codec_type') == 'audio' for stream in await probe_streams(file_path))
+        encodes = [encode_chunk(chunk, encoded_chunk) for chunk, encoded_chunk in zip(chunks, encoded_chunks)]
+        audio_path = None
+        if has_audio:
+            audio_path = os.path.join(chunk_dir, 'audio.m4a')
+            encodes.append(check_process(['ffmpeg', '-y', '-nostats', '-v', 'error', '-i', file_path, '-map', '0:a:0', '-vn', *audio_options, audio_path], timeout=None))
+        await run_all(encodes)
+
+        list_path = os.path.join(chunk_dir, 'chunks.txt')
+        with open(list_path, 'w') as f:
+            for encoded_chunk in encoded_chunks:
+                escaped_path = encoded_chunk.replace("'", "'\\''")
+                f.write(f"file '{escaped_path}'\n")
+        concat_command = ['ffmpeg', '-y', '-nostats', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if audio_path:
+            concat_command.extend(['-i', audio_path, '-map', '0:v', '-map', '1:a'])
+        concat_command.extend(['-c', 'copy', '-movflags', 'faststart', compressed_path])
+        await check_process(concat_command, timeout=None)
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
+
+# Probed metadata: refined URL -> (timestamp, info dict)
+preflight_cache = OrderedDict()
+PREFLIGHT_CACHE_MAX_ENTRIES = 200
+
+async def probe_media(url: str, settings: dict) -> dict:
+    """Read a URL's metadata and available formats with yt-dlp, without downloading"""
+    info = get_probed_info(url)
+    if info is not None:
+        return info
+
+    cmd = [YTDLP_BIN, *build_ytdlp_base_options(settings), '-f', VIDEO_FORMAT_SELECTION, '--dump-json', '--skip-download', url]
+    async with job_scheduler.stage('download'):
+        with stage_timer('preflight'):
+            # The metadata is a single JSON line that can be several MB long
+            returncode, stdout, stderr = await run_ytdlp(cmd, settings, timeout=120, output_limit=64 * MB_IN_BYTES)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, stdout, stderr)
+    info = json.loads(next(line for line in stdout.splitlines() if line.startswith('{')))
+    remember_probe(url, info)
+    return info
+
+def get_probed_info(url: str):
+    """Return the metadata read for a URL within PREFLIGHT_CACHE_TTL, or None"""
+    entry = preflight_cache.get(url)
+    if entry is not None and time.time() - entry[0] < PREFLIGHT_CACHE_TTL:
+        return entry[1]
+    return None
+
+def write_info_json(info: dict, job_dir: str) -> str:
+    """Write metadata for yt-dlp --load-info-json into the job directory and return the path"""
+    info_json_path = os.path.join(job_dir, 'info.json')
+    with open(info_json_path, 'w') as f:
+        json.dump(info, f)
+    return info_json_path
+
+def remember_probe(url: str, info: dict) -> None:
+    preflight_cache[url] = (time.time(), info)
+    while len(preflight_cache) > PREFLIGHT_CACHE_MAX_ENTRIES:
+        preflight_cache.popitem(last=False)
+
+async def resolve_batch(urls: list, settings: dict) -> list:
+    """Resolve the links of one message with a single yt-dlp run and return the links to download.
+
+    With the 'expand_playlists' setting, playlists are replaced by their items, read with
+    --flat-playlist. The full metadata returned for the other links is kept for the pre-flight
+    probe and the download, so they aren't extracted again. If the run fails, the links are
+    used as given.
+    """
+    options = build_ytdlp_base_options(settings)
+    if settings['expand_playlists']:
+        options = [option for option in options if option != '--no-playlist']
+        options += ['--yes-playlist', '--flat-playlist', '--playlist-items', f'1:{BATCH_MAX_ITEMS}']
+    cmd = [YTDLP_BIN, *options, '-f', VIDEO_FORMAT_SELECTION, '--dump-json', '--skip-download', '--ignore-errors', *urls]
+    try:
+        async with job_scheduler.stage('download'):
+            with stage_timer('resolve'):
+                returncode, stdout, stderr = await run_ytdlp(cmd, settings, timeout=120, output_limit=64 * MB_IN_BYTES * len(urls))
+    except (OSError, asyncio.TimeoutError) as e:
+        logger.warning(f"Resolving {len(urls)} links failed: {e}")
+        return urls
+    if returncode != 0:
+        # --ignore-errors keeps going past broken links, they are dropped from the result
+        logger.warning(f"yt-dlp could not resolve some links: {stderr[-500:]}")
+
+    resolved = []
+    for line in stdout.splitlines():
+        if not line.startswith('{'):
+            continue
+        info = json.loads(line)
+        url = info.get('webpage_url') or info.get('url')
+        if not url:
+            continue
+        resolved.append(url)
+        if info.get('formats'):
+            refined_url, _ = await refine_url_and_filename(url)
+            remember_probe(refined_url, info)
+    return list(dict.fromkeys(resolved)) or urls
+
+def estimate_format_size(fmt: dict):
+    """Return the size of a format in bytes, padding approximate sizes, or None if unknown"""
+    if fmt.get('filesize'):
+        return fmt['filesize']
+    if fmt.get('filesize_approx'):
+        return int(fmt['filesize_approx'] * 1.1)
+    return None
+
+def choose_fitting_format(info: dict, size_limit_bytes: float):
+    """Pick the best format (or video+audio pair) whose reported size fits the limit.
+
+    Follows the same preferences as VIDEO_FORMAT_SELECTION: h264 with AAC first, then the
+    highest resolution up to 1080p. Returns (format selection, estimated bytes) or None.
+    """
+    formats = [fmt for fmt in info.get('formats') or [] if estimate_format_size(fmt)]
+    has_video = lambda fmt: fmt.get('vcodec') not in (None, 'none')
+    has_audio = lambda fmt: fmt.get('acodec') not in (None, 'none')
+
+    candidates = []
+    for video in formats:
+        if not has_video(video) or (video.get('height') or 0) > 1080:
+            continue
+        pairs = [video] if has_audio(video) else [audio for audio in formats if has_audio(audio) and not has_video(audio)]
+        for audio in pairs:
+            size = estimate_format_size(video) + (estimate_format_size(audio) if audio is not video else 0)
+            if size > size_limit_bytes:
+                continue
+            compatible = (video.get('vcodec') or '').startswith('avc1') and (audio.get('acodec') or '').startswith('mp4a')
+            rank = (compatible, video.get('height') or 0, video.get('tbr') or 0, audio.get('abr') or 0)
+            selection = video['format_id'] if audio is video else f"{video['format_id']}+{audio['format_id']}"
+            candidates.append((rank, selection, size))
+
+    if not candidates:
+        return None
+    _, selection, size = max(candidates, key=lambda candidate: candidate[0])
+    return selection, size
+
+def estimate_download_size(info: dict):
+    """Estimate the bytes the default format selection would download, or None if unknown"""
+    requested = info.get('requested_formats') or [info]
+    sizes = [estimate_format_size(fmt) for fmt in requested]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+def estimate_audio_size(info: dict):
+    """Estimate the bytes of the best audio-only format, or None if unknown"""
+    sizes = [
+        estimate_format_size(fmt) for fmt in info.get('formats') or []
+        if fmt.get('vcodec') in (None, 'none') and fmt.get('acodec') not in (None, 'none')
+    ]
+    if not sizes or None in sizes:
+        return estimate_download_size(info)
+    return max(sizes)
+
+async def preflight_job(update: Update, refined_url: str, settings: dict, job_dir: str):
+    """Probe a URL before downloading it.
 
-async def download_video(update: Update, context: CallbackContext) -> None:
+    Returns (format selection, info JSON path, estimated bytes) to download with, or None if the
+    job was refused. If probing fails the job continues with the usual format selection.
+    """
+    try:
+        info = await probe_media(refined_url, settings)
+    except Exception as e:
+        logger.warning(f"Pre-flight probe failed for {refined_url}: {e}")
+        return None, None, None
+
+    duration = info.get('duration') or 0
+    if MAX_DURATION and duration > MAX_DURATION:
+        await update.message.reply_text(f"This video is {format_duration(duration)} long, the limit is {format_duration(MAX_DURATION)}.")
+        return None
+
+    limit_bytes = UPLOAD_SIZE_LIMIT_MB * MB_IN_BYTES * SPLIT_SIZE_MARGIN
+    fitting = choose_fitting_format(info, limit_bytes)
+    if fitting is not None:
+        format_selection, estimated_bytes = fitting
+        plan = 'direct'
+    else:
+        format_selection, estimated_bytes = None, estimate_download_size(info)
+        if estimated_bytes is None:
+            plan = 'unknown'
+        elif estimated_bytes <= limit_bytes:
+            plan = 'direct'
+        elif settings['compress_video'] and plan_target_bitrate(duration, UPLOAD_SIZE_LIMIT_MB):
+            plan = 'compress'
+        elif settings['split_large_files']:
+            plan = 'split'
+        else:
+            plan = 'oversize'
+
+    if MAX_SOURCE_SIZE_MB and estimated_bytes and estimated_bytes > MAX_SOURCE_SIZE_MB * MB_IN_BYTES:
+        await update.message.reply_text(f"This video is about {estimated_bytes / MB_IN_BYTES:.0f} MB, the limit is {MAX_SOURCE_SIZE_MB} MB.")
+        return None
+
+    size_text = f"~{estimated_bytes / MB_IN_BYTES:.1f} MB" if estimated_bytes else "unknown size"
+    logger.info(
+        f"Pre-flight {refined_url}: {format_duration(duration)}, {size_text}, format {format_selection or 'default'}, plan {plan}",
+        extra={'url': refined_url, 'media_duration': duration, 'bytes': estimated_bytes, 'stage': 'preflight'}
+    )
+
+    if plan == 'oversize':
+        await update.message.reply_text(
+            f"This video is about {estimated_bytes / MB_IN_BYTES:.0f} MB, more than the {UPLOAD_SIZE_LIMIT_MB} MB upload limit. "
+            "Turn on compression or splitting in /settings to download it."
+        )
+        return None
+
+    return format_selection, write_info_json(info, job_dir), estimated_bytes
+
+class QueueFullError(Exception):
+    """Raised when a job can't be queued because the backlog is full."""
+
+class JobScheduler:
+    """Bounded job queue with round-robin fairness between users.
+
+    Jobs wait in a per-user queue and are started one user at a time in turn,
+    so a user who sends many links can't starve everyone else. Each processing
+    stage (download, transcode, upload) has its own worker pool, acquired with
+    `async with job_scheduler.stage(name):`.
+    """
+
+    def __init__(self, max_jobs: int, max_per_user: int, max_queued: int, max_queued_per_user: int, stage_limits: dict):
+        self.max_jobs = max_jobs
+        self.max_per_user = max_per_user
+        self.max_queued = max_queued
+        self.max_queued_per_user = max_queued_per_user
+        self.stage_limits = stage_limits
+        self._stages = {}
+        self._queues = OrderedDict()  # user_id -> deque of job factories
+        self._active = {}  # user_id -> number of running jobs
+        self._running = 0
+        self._tasks = set()
+
+    @property
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def stage(self, name: str) -> asyncio.Semaphore:
+        """Return the worker pool semaphore for a processing stage."""
+        # Created lazily so the semaphores bind to the running event loop
+        if name not in self._stages:
+            self._stages[name] = asyncio.Semaphore(self.stage_limits[name])
+        return self._stages[name]
+
+    def submit(self, user_id: int, job_factory) -> int:
+        """Queue a job and return its estimated position (0 if it started right away).
+
+        `job_factory` is a callable returning the coroutine to run.
+        Raises QueueFullError if the global or per-user backlog is full.
+        """
+        queue = self._queues.get(user_id)
+        if queue is not None and len(queue) >= self.max_queued_per_user:
+            raise QueueFullError(f"You already have {len(queue)} requests waiting. Please wait for them to finish.")
+        if self.queued >= self.max_queued:
+            raise QueueFullError("The bot is busy right now. Please try again in a few minutes.")
+
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+        queue.append(job_factory)
+        self._dispatch()
+
+        queue = self._queues.get(user_id, ())
+        if job_factory not in queue:
+            return 0
+        index = queue.index(job_factory)
+        # Round-robin estimate: every other user gets up to as many turns before this job
+        ahead = sum(min(len(other), index + 1) for uid, other in self._queues.items() if uid != user_id)
+        return ahead + index + 1
+
+    def _dispatch(self) -> None:
+        """Start queued jobs while there are free slots, rotating between users."""
+        while self._running < self.max_jobs:
+            user_id = next(
+                (uid for uid in self._queues if self._active.get(uid, 0) < self.max_per_user),
+                None
+            )
+            if user_id is None:
+                return
+            queue = self._queues[user_id]
+            job_factory = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+            self._running += 1
+            task = asyncio.ensure_future(self._run(user_id, job_factory))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def shutdown(self) -> None:
+        """Drop queued jobs and cancel running ones, killing their processes"""
+        self._queues.clear()
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, user_id: int, job_factory) -> None:
+        try:
+            await job_factory()
+        except Exception as e:
+            logger.error(f"Unhandled error in job for user {user_id}: {e}")
+        finally:
+            self._running -= 1
+            self._active[user_id] -= 1
+            if not self._active[user_id]:
+                del self._active[user_id]
+            self._dispatch()
+
+job_scheduler = JobScheduler(
+    MAX_CONCURRENT_JOBS, MAX_JOBS_PER_USER, MAX_QUEUED_JOBS, MAX_QUEUED_PER_USER,
+    {'download': DOWNLOAD_WORKERS, 'transcode': TRANSCODE_WORKERS, 'upload': UPLOAD_WORKERS}
+)
+
+def directory_size(path: str) -> int:
+    """Return the total size of the files under a directory"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def estimate_job_space(download_bytes, audio_only: bool = False) -> int:
+    """Peak scratch space of a job.
+
+    A video job needs the download while it's merged, plus a compressed copy or split parts.
+    An audio job needs the download plus its converted copy.
+    """
+    if download_bytes is None:
+        return JOB_SPACE_ESTIMATE_MB * MB_IN_BYTES
+    if audio_only:
+        return int(download_bytes * 2)
+    return int(download_bytes * 2 + min(download_bytes, UPLOAD_SIZE_LIMIT_MB * MB_IN_BYTES))
+
+class StorageBudget:
+    """Scratch disk space reserved by running jobs.
+
+    A job reserves its estimated peak usage before downloading. It waits while that, plus what
+    the other jobs are still expected to write, would leave less than `min_free_bytes` free.
+    Reservations are released when the job's directory is removed.
+    """
+
+    def __init__(self, path: str, min_free_bytes: int):
+        self.path = path
+        self.min_free_bytes = min_free_bytes
+        self._reservations = {}  # job_dir -> reserved bytes
+        self._released = None  # Event set on the next release
+        self._admitting = None  # Lock admitting one job at a time, in arrival order
+
+    @property
+    def reserved(self) -> int:
+        return sum(self._reservations.values())
+
+    def _available(self, reservations: list) -> int:
+        # Files a job already wrote are counted by the disk, only the rest of its reservation is pending
+        pending = sum(max(0, reserved - directory_size(job_dir)) for job_dir, reserved in reservations)
+        return shutil.disk_usage(self.path).free - self.min_free_bytes - pending
+
+    async def available(self) -> int:
+        """Free bytes not yet claimed by running jobs"""
+        # Walking the job directories is slow on a busy disk, keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self._available, list(self._reservations.items()))
+
+    async def reserve(self, job_dir: str, nbytes: int, known_size: bool = True, on_wait=None) -> bool:
+        """Wait until `nbytes` can be reserved for a job. Returns False if it can never fit.
+
+        A guessed size (`known_size` false) never refuses the job: it starts once no other job
+        is running, with whatever space is left.
+        """
+        # Created lazily so the lock binds to the running event loop
+        if self._admitting is None:
+            self._admitting = asyncio.Lock()
+        async with self._admitting:
+            while True:
+                available = await self.available()
+                if nbytes <= available:
+                    break
+                if not self._reservations:
+                    # Nothing running will free space
+                    if known_size:
+                        return False
+                    nbytes = max(0, available)
+                    break
+                if on_wait is not None:
+                    on_wait()
+                    on_wait = None
+                if self._released is None:
+                    self._released = asyncio.Event()
+                try:
+                    # Also re-check now and then, space may be freed outside the bot
+                    await asyncio.wait_for(self._released.wait(), 10)
+                except asyncio.TimeoutError:
+                    pass
+            self._reservations[job_dir] = nbytes
+            return True
+
+    def release(self, job_dir: str) -> None:
+        if self._reservations.pop(job_dir, None) is not None and self._released is not None:
+            self._released.set()
+            self._released = None
+
+storage_budget = StorageBudget(SUBDIR, MIN_FREE_DISK_MB * MB_IN_BYTES)
+active_job_dirs = set()
+
+async def reserve_job_space(update: Update, refined_url: str, job_dir: str, download_bytes, progress: ProgressTracker = None, audio_only: bool = False) -> bool:
+    """Hold a job back until the disk has room for everything it may write. Returns False after telling the user it can't fit."""
+    space = estimate_job_space(download_bytes, audio_only)
+    on_wait = (lambda: progress.set_stage('Waiting for disk space')) if progress is not None else None
+    with stage_timer('disk_wait'):
+        reserved = await storage_budget.reserve(job_dir, space, known_size=download_bytes is not None, on_wait=on_wait)
+    if not reserved:
+        logger.warning(f"Not enough disk space for {refined_url}: needs {space / MB_IN_BYTES:.0f} MB")
+        await update.message.reply_text("There isn't enough disk space for this download right now. Please try again later.")
+    return reserved
+
+async def sweep_downloads() -> None:
+    """Periodically remove scratch files older than JOB_DIR_MAX_AGE that no running or journaled job uses"""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            keep = {os.path.abspath(job_dir) for job_dir in active_job_dirs | journaled_job_dirs()}
+            for path in glob.glob(os.path.join(SUBDIR, '*')):
+                if os.path.abspath(path) in keep or time.time() - os.path.getmtime(path) < JOB_DIR_MAX_AGE:
+                    continue
+                logger.info(f"Sweeping expired scratch file {path}")
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        except Exception as e:
+            logger.error(f"Error sweeping {SUBDIR}: {e}")
+
+async def send_cached_files(update: Update, context: CallbackContext, items: list) -> None:
+    """Re-send previously uploaded files by file_id"""
+    for item in items:
+        if item['type'] == 'audio':
+            await context.bot.send_audio(chat_id=update.effective_chat.id, audio=item['file_id'], caption=item.get('caption'))
+        else:
+            await context.bot.send_document(chat_id=update.effective_chat.id, document=item['file_id'], caption=item.get('caption'))
+
+# Requests currently being downloaded: flight key -> future resolved when the job ends
+in_flight = {}
+# Requests waiting in the scheduler queue, moved to in_flight when they start
+queued_flights = {}
+follower_tasks = set()
+
+def make_flight_key(refined_url: str, settings: dict) -> str:
+    """Key identifying requests that produce exactly the same uploads"""
+    key = make_cache_key(refined_url, settings)
+    if settings['download_audio'] and not settings['audio_only']:
+        key += '|with_audio'
+    return key
+
+async def run_single_flight(key: str, done, job) -> None:
+    """Run a job and let requests waiting on the same key know when it ends"""
+    in_flight[key] = done
+    try:
+        await job
+    finally:
+        if in_flight.get(key) is done:
+            del in_flight[key]
+        if not done.done():
+            done.set_result(None)
+
+async def run_queued_flight(update: Update, context: CallbackContext, url: str, refined_url: str, settings: dict, key: str, done, job_id=None) -> None:
+    """Start a queued request, or only send its result if a batch took the download over while it waited"""
+    if queued_flights.get(key) is done:
+        del queued_flights[key]
+        await run_single_flight(key, done, download_video(update, context, url, job_id))
+    else:
+        await wait_for_flight(update, context, done, refined_url, settings, job_id)
+
+async def wait_for_flight(update: Update, context: CallbackContext, done, refined_url: str, settings: dict, job_id=None) -> None:
+    """Wait for an identical request to finish and send its uploads"""
+    await asyncio.shield(done)
+    try:
+        cached_items = lookup_cached_request(refined_url, settings)
+        if cached_items is None:
+            await update.message.reply_text("The download of this link failed. Please try again later.")
+            return
+        await send_cached_files(update, context, cached_items)
+    except Exception as e:
+        logger.error(f"Failed to send coalesced result for {refined_url}: {e}")
+        await update.message.reply_text(f"Failed to send the video: {e}")
+    finally:
+        journal_remove(job_id)
+
+URL_RE = re.compile(r'https?://[^\s<>"]+')
+
+async def handle_message(update: Update, context: CallbackContext, job_id=None) -> None:
+    """Handle a message with one or more links.
+
+    A single link is handled on its own, several links (or a playlist link, with the
+    'expand_playlists' setting) are handled together as a batch. `job_id` is given when
+    resuming a journaled request after a restart.
+    """
     settings = get_user_settings(update.effective_user.id)
-    refined_url, filename_base = await refine_url_and_filename(update.message.text)
+    artifacts = journal_artifacts(job_id)
+    if 'url' in artifacts:
+        # An item of a batch, resumed on its own
+        await handle_url(update, context, artifacts['url'], settings, job_id)
+        return
 
-    # Create downloads directory if it doesn't exist
-    if not os.path.exists(SUBDIR):
-        os.makedirs(SUBDIR)
+    # Links pasted in a sentence often end in punctuation that isn't part of them
+    found = [url.rstrip('.,;:!?)]') for url in URL_RE.findall(update.message.text)]
+    urls = artifacts.get('urls') or list(dict.fromkeys(found))
+    if len(urls) > 1 or (urls and settings['expand_playlists']):
+        await handle_batch(update, context, urls, settings, job_id)
+    else:
+        await handle_url(update, context, urls[0] if urls else update.message.text, settings, job_id)
 
-    # If audio_only is enabled, only download audio
-    if settings['audio_only']:
-        await update.message.reply_text(f"Downloading audio only from: {refined_url}")
-        await download_audio_only(update, context, refined_url, filename_base, settings)
+async def answer_from_cache(update: Update, context: CallbackContext, refined_url: str, settings: dict) -> bool:
+    """Send a link's cached uploads; False if there are none or they can no longer be sent"""
+    cached_items = lookup_cached_request(refined_url, settings)
+    if cached_items is None:
+        return False
+    try:
+        await send_cached_files(update, context, cached_items)
+    except BadRequest as e:
+        # The file_id is no longer usable, download it again
+        logger.warning(f"Cached file for {refined_url} could not be sent: {e}")
+        invalidate_cached_files(refined_url)
+        return False
+    metrics.inc('video_dl_cache_hits_total')
+    logger.info(f"Answered {refined_url} from the file cache")
+    return True
+
+async def handle_url(update: Update, context: CallbackContext, url: str, settings: dict, job_id=None) -> None:
+    """Answer a download request from the cache, join an identical running request, or queue it"""
+    with stage_timer('refine'):
+        refined_url, _ = await refine_url_and_filename(url)
+    record_request(refined_url)
+
+    if await answer_from_cache(update, context, refined_url, settings):
+        journal_remove(job_id)
         return
 
-    await update.message.reply_text(f"Downloading video from: {refined_url}")
+    # Someone already requested the same output, wait for their job instead of starting another
+    flight_key = make_flight_key(refined_url, settings)
+    if job_id is None:
+        job_id = journal_add(update, url=url)
+    flight = in_flight.get(flight_key) or queued_flights.get(flight_key)
+    if flight is not None:
+        metrics.inc('video_dl_coalesced_requests_total')
+        await update.message.reply_text("This link is already being downloaded. You'll get it as soon as it's ready.")
+        task = asyncio.ensure_future(wait_for_flight(update, context, flight, refined_url, settings, job_id))
+        follower_tasks.add(task)
+        task.add_done_callback(follower_tasks.discard)
+        return
 
-    # Build and run the improved yt-dlp command
-    video_path = f'{SUBDIR}/{filename_base}'
-    cmd = build_video_command(refined_url, video_path, settings)
-    logger.info(f"Running yt-dlp command: {' '.join(cmd)}")
+    done = asyncio.get_running_loop().create_future()
+    queued_flights[flight_key] = done
+    try:
+        position = job_scheduler.submit(
+            update.effective_user.id,
+            lambda: run_queued_flight(update, context, url, refined_url, settings, flight_key, done, job_id)
+        )
+    except QueueFullError as e:
+        del queued_flights[flight_key]
+        journal_remove(job_id)
+        await update.message.reply_text(str(e))
+        return
 
-    success, stdout, stderr = run_ytdlp_command(cmd)
+    if position:
+        await update.message.reply_text(f"Your request is queued (position {position}).")
 
-    if not success:
-        # Extract meaningful error message from stderr
-        error_lines = [line for line in stderr.split('\n') if 'ERROR' in line or 'error' in line.lower()]
-        error_msg = '\n'.join(error_lines[-3:]) if error_lines else stderr[-500:] if stderr else 'Unknown error'
-        logger.error(f"Download failed: {stderr}")
-        await update.message.reply_text(f"Download failed:\n{error_msg}")
+async def handle_batch(update: Update, context: CallbackContext, urls: list, settings: dict, job_id=None) -> None:
+    """Queue the links of one message as a single job"""
+    if job_id is None:
+        job_id = journal_add(update, urls=urls)
+    try:
+        position = job_scheduler.submit(
+            update.effective_user.id,
+            lambda: run_batch(update, context, urls, settings, job_id)
+        )
+    except QueueFullError as e:
+        journal_remove(job_id)
+        await update.message.reply_text(str(e))
         return
 
-    logger.info(f"Video downloaded successfully! Output:\n{stdout}")
+    if position:
+        await update.message.reply_text(f"Your links are queued (position {position}).")
+
+class BatchProgress:
+    """Progress of the items of a batch, shown together in one status message"""
+
+    def __init__(self, status: StatusMessage, total: int):
+        self.status = status
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self._running = {}  # ProgressTracker -> item name, in start order
+
+    def track(self, name: str) -> ProgressTracker:
+        """Return the tracker for an item that is starting"""
+        progress = ProgressTracker(on_change=lambda _: self._render())
+        self._running[progress] = name
+        active_trackers.add(progress)
+        self._render()
+        return progress
+
+    def finish(self, progress: ProgressTracker, sent: bool) -> None:
+        self._running.pop(progress, None)
+        active_trackers.discard(progress)
+        if sent:
+            self.sent += 1
+        else:
+            self.failed += 1
+        self._render()
+
+    def summary(self) -> str:
+        summary = f"{self.sent + self.failed}/{self.total} done"
+        if self.failed:
+            summary += f", {self.failed} failed"
+        return summary
+
+    def _render(self) -> None:
+        lines = [self.summary()] + [f"{name}: {progress.render()}" for progress, name in self._running.items()]
+        self.status.set('\n'.join(lines))
+
+async def run_batch(update: Update, context: CallbackContext, urls: list, settings: dict, job_id=None) -> None:
+    """Download the links of one message, BATCH_WORKERS at a time, with one status message for all of them"""
+    if settings['expand_playlists'] or PREFLIGHT_PROBE:
+        urls = await resolve_batch(urls, settings)
+    if len(urls) > BATCH_MAX_ITEMS:
+        await update.message.reply_text(f"Only the first {BATCH_MAX_ITEMS} of {len(urls)} links will be downloaded.")
+        urls = urls[:BATCH_MAX_ITEMS]
+
+    # From here on every item has a journal entry of its own and is resumed separately
+    item_job_ids = [journal_add(update, url=url) for url in urls]
+    journal_remove(job_id)
+
+    status_message = await update.message.reply_text(f"Downloading {len(urls)} links:")
+    batch = BatchProgress(StatusMessage(status_message, status_message.text), len(urls))
+    workers = asyncio.Semaphore(BATCH_WORKERS)
+
+    async def run_item(url: str, item_job_id) -> None:
+        async with workers:
+            await run_batch_item(update, context, url, settings, batch, item_job_id)
 
     try:
-        video_file_path = find_downloaded_file(filename_base)
-    except FileNotFoundError as e:
-        logger.error(f"Could not find downloaded file: {e}")
-        await update.message.reply_text(f"Download completed but file not found. Check logs for details.")
+        await run_all([run_item(url, item_job_id) for url, item_job_id in zip(urls, item_job_ids)])
+        batch.status.set(f"{batch.summary()}\nFinished.")
+    finally:
+        await batch.status.close()
+
+async def run_batch_item(update: Update, context: CallbackContext, url: str, settings: dict, batch: BatchProgress, job_id=None) -> None:
+    """Handle one link of a batch like a single request, reporting progress to the batch"""
+    refined_url, filename_base = await refine_url_and_filename(url)
+    record_request(refined_url)
+    progress = batch.track(filename_base)
+    try:
+        if await answer_from_cache(update, context, refined_url, settings):
+            journal_remove(job_id)
+            return
+        flight_key = make_flight_key(refined_url, settings)
+        if flight_key in in_flight:
+            # A running job finishes without needing this batch's scheduler slot
+            metrics.inc('video_dl_coalesced_requests_total')
+            await wait_for_flight(update, context, in_flight[flight_key], refined_url, settings, job_id)
+            return
+        # A queued request for the same link may only start once this batch frees its slot,
+        # so the batch does the download and the queued request just sends the result
+        done = queued_flights.pop(flight_key, None)
+        if done is None:
+            done = asyncio.get_running_loop().create_future()
+        await run_single_flight(flight_key, done, download_video(update, context, url, job_id, progress))
+    except Exception as e:
+        logger.error(f"Batch item {refined_url} failed: {e}")
+        journal_remove(job_id)
+    finally:
+        batch.finish(progress, lookup_cached_request(refined_url, settings) is not None)
+
+async def resume_unfinished_jobs(application: Application) -> None:
+    """Queue the requests the previous run didn't finish; they continue from their last finished stage"""
+    for job in unfinished_jobs:
+        job_dir = job['artifacts'].get('job_dir')
+        if job['resumes'] >= JOB_MAX_RESUMES:
+            logger.warning(f"Giving up on job {job['job_id']} after {job['resumes']} interruptions")
+            journal_remove(job['job_id'])
+            if job_dir:
+                shutil.rmtree(job_dir, ignore_errors=True)
+            continue
+        try:
+            journal_mark_resumed(job['job_id'])
+            update = Update.de_json(job['update'], application.bot)
+            context = CallbackContext.from_update(update, application)
+            logger.info(f"Resuming job {job['job_id']} from stage {job['stage']}")
+            await update.message.reply_text("The bot was restarted while working on this link. Resuming it...")
+            await handle_message(update, context, job['job_id'])
+        except Exception as e:
+            logger.error(f"Failed to resume job {job['job_id']}: {e}")
+            journal_remove(job['job_id'])
+    unfinished_jobs.clear()
+
+async def download_video(update: Update, context: CallbackContext, url: str, job_id=None, progress: ProgressTracker = None) -> None:
+    settings = get_user_settings(update.effective_user.id)
+    refined_url, filename_base = await refine_url_and_filename(url)
+
+    # Every job works in its own scratch directory, removed when the job ends.
+    # A resumed job continues in the directory it had, reusing partial downloads.
+    job_dir = journal_artifacts(job_id).get('job_dir')
+    if job_dir is None or not os.path.isdir(job_dir):
+        job_dir = create_job_dir()
+        journal_update(job_id, 'started', job_dir=job_dir)
+    active_job_dirs.add(job_dir)
+    interrupted = False
+    try:
+        await run_download_job(update, context, refined_url, filename_base, settings, job_dir, job_id, progress)
+    except asyncio.CancelledError:
+        # The bot is shutting down, keep the journal entry and files to resume the job
+        interrupted = True
+        raise
+    finally:
+        if not interrupted:
+            journal_remove(job_id)
+            with stage_timer('cleanup'):
+                shutil.rmtree(job_dir, ignore_errors=True)
+        active_job_dirs.discard(job_dir)
+        storage_budget.release(job_dir)
+
+@asynccontextmanager
+async def job_progress(update: Update, header: str, progress: ProgressTracker = None):
+    """Yield the progress tracker of a job: `progress` for an item of a batch, otherwise
+    a new one shown in a status message of its own"""
+    if progress is not None:
+        yield progress
         return
+    status_message = await update.message.reply_text(header)
+    status = StatusMessage(status_message, status_message.text)
+    progress = ProgressTracker(on_change=status.set)
+    active_trackers.add(progress)
+    try:
+        yield progress
+        status.set("Finished.")
+    finally:
+        active_trackers.discard(progress)
+        await status.close()
 
-    video_size = os.path.getsize(video_file_path)
-    await update.message.reply_text(f"Video downloaded: {os.path.basename(video_file_path)} ({video_size / MB_IN_BYTES:.2f} MB)")
+async def run_download_job(update: Update, context: CallbackContext, refined_url: str, filename_base: str, settings: dict, job_dir: str, job_id=None, progress: ProgressTracker = None) -> None:
+    """Handle one download request inside its scratch directory"""
+    # If audio_only is enabled, only download audio
+    if settings['audio_only']:
+        async with job_progress(update, f"Downloading audio only from: {refined_url}", progress) as progress:
+            await download_audio_only(update, context, refined_url, filename_base, settings, job_dir, progress)
+        return
+
+    cache_key = make_cache_key(refined_url, settings)
+    cached_items = get_cached_files(cache_key)
+    if cached_items is not None:
+        # The video was uploaded before, only the audio is missing
+        await send_cached_files(update, context, cached_items)
+        if settings['download_audio']:
+            await download_audio_only(update, context, refined_url, filename_base + "_audio", settings, job_dir)
+        return
+
+    async with job_progress(update, f"Downloading video from: {refined_url}", progress) as progress:
+        await download_and_send_video(update, context, refined_url, filename_base, settings, job_dir, cache_key, progress, job_id)
+
+async def download_and_send_video(update: Update, context: CallbackContext, refined_url: str, filename_base: str, settings: dict, job_dir: str, cache_key: str, progress: ProgressTracker, job_id=None) -> None:
+    """Download a video and send it, compressing or splitting it when it's too large"""
+    artifacts = journal_artifacts(job_id)
+    video_file_path = artifacts.get('video')
+    if video_file_path and os.path.isfile(video_file_path):
+        logger.info(f"Resuming {refined_url} with the already downloaded {video_file_path}")
+        video_size = os.path.getsize(video_file_path)
+    else:
+        video_file_path = await download_video_file(update, refined_url, filename_base, settings, job_dir, progress)
+        if video_file_path is None:
+            return
+        video_size = os.path.getsize(video_file_path)
+
+        # Dropping extra tracks and container overhead is much cheaper than re-encoding
+        if video_size / MB_IN_BYTES > UPLOAD_SIZE_LIMIT_MB:
+            remuxed_path = await remux_video(video_file_path)
+            if remuxed_path is not None:
+                video_file_path = remuxed_path
+                video_size = os.path.getsize(video_file_path)
+        journal_update(job_id, 'downloaded', video=video_file_path)
+
+    # Build the audio version from this download while the video is being sent
+    audio_task = None
+    if settings['download_audio']:
+        audio_task = asyncio.ensure_future(
+            extract_and_send_audio(update, context, video_file_path, refined_url, filename_base + "_audio", settings)
+        )
 
     # Handle video sending
+    sent_file_ids = None
+    compressed_path = artifacts.get('compressed')
+    progress.set_stage('Processing')
     try:
         if video_size / MB_IN_BYTES > UPLOAD_SIZE_LIMIT_MB:
+            # Only compress when the target size is reachable at a watchable bitrate
+            video_bitrate_kbps = None
             if settings['compress_video']:
-                await update.message.reply_text("Video is too large. Compressing...")
-                compressed_path = await compress_video(video_file_path)
+                duration = await get_video_duration(video_file_path)
+                video_bitrate_kbps = plan_target_bitrate(duration, UPLOAD_SIZE_LIMIT_MB)
+                if video_bitrate_kbps is None:
+                    logger.info(f"Compressing {video_file_path} ({duration:.0f}s) can't reach {UPLOAD_SIZE_LIMIT_MB} MB")
+
+            if video_bitrate_kbps is not None:
+                if compressed_path and os.path.isfile(compressed_path):
+                    logger.info(f"Resuming {refined_url} with the already compressed {compressed_path}")
+                else:
+                    await update.message.reply_text(f"Video is too large. Compressing to fit {UPLOAD_SIZE_LIMIT_MB} MB...")
+                    progress.set_stage('Compressing', duration)
+                    compressed_path = await compress_video(video_file_path, video_bitrate_kbps, progress, duration)
+                    journal_update(job_id, 'compressed', compressed=compressed_path)
                 compressed_size = os.path.getsize(compressed_path)
                 if compressed_size / MB_IN_BYTES <= UPLOAD_SIZE_LIMIT_MB:
-                    await send_video(update, context, compressed_path)
+                    sent_file_ids = [await send_video(update, context, compressed_path)]
                     os.remove(compressed_path)
                 else:
                     os.remove(compressed_path)
                     if settings['split_large_files']:
-                        await split_and_send_video(update, context, video_file_path, filename_base)
+                        sent_file_ids = await split_and_send_video(update, context, video_file_path, filename_base, job_id)
                     else:
                         await update.message.reply_text("Video is too large to send, even after compression. Attempting to send directly...")
-                        await send_video(update, context, video_file_path)
+                        sent_file_ids = [await send_video(update, context, video_file_path)]
             elif settings['split_large_files']:
-                await split_and_send_video(update, context, video_file_path, filename_base)
+                sent_file_ids = await split_and_send_video(update, context, video_file_path, filename_base, job_id)
             else:
-                await send_video(update, context, video_file_path)
+                if settings['compress_video']:
+                    await update.message.reply_text("Video is too long to compress enough. Attempting to send directly...")
+                sent_file_ids = [await send_video(update, context, video_file_path)]
         else:
-            await send_video(update, context, video_file_path)
+            sent_file_ids = [await send_video(update, context, video_file_path)]
+    except asyncio.CancelledError:
+        if audio_task is not None:
+            audio_task.cancel()
+        raise
     except Exception as e:
         logger.error(f"Error during video processing/sending: {e}")
         await update.message.reply_text(f"Error during video processing/sending: {e}")
 
-    # Download audio if enabled and no fatal error occurred
-    if settings['download_audio'] and not settings['audio_only']:
-        await download_audio_only(update, context, refined_url, filename_base + "_audio", settings)
+    if sent_file_ids:
+        store_cached_files(cache_key, [{'type': 'document', 'file_id': file_id} for file_id in sent_file_ids])
+
+    if audio_task is not None:
+        await audio_task
 
     # Clean up video file
     if os.path.exists(video_file_path):
         os.remove(video_file_path)
 
-async def download_audio_only(update: Update, context: CallbackContext, url: str, filename_base: str, settings: dict) -> None:
+async def download_video_file(update: Update, refined_url: str, filename_base: str, settings: dict, job_dir: str, progress: ProgressTracker):
+    """Download a video into the job directory and return its path, or None after telling the user why it failed"""
+    format_selection, info_json_path, estimated_bytes = None, None, None
+    if PREFLIGHT_PROBE:
+        progress.set_stage('Checking formats')
+        preflight = await preflight_job(update, refined_url, settings, job_dir)
+        if preflight is None:
+            return None
+        format_selection, info_json_path, estimated_bytes = preflight
+    elif get_probed_info(refined_url) is not None:
+        # Metadata read when the link's batch was resolved saves extracting the URL again
+        info = get_probed_info(refined_url)
+        info_json_path = write_info_json(info, job_dir)
+        estimated_bytes = estimate_download_size(info)
+
+    if not await reserve_job_space(update, refined_url, job_dir, estimated_bytes, progress):
+        return None
+
+    # Build and run the improved yt-dlp command; partial downloads left in job_dir are continued
+    video_path = os.path.join(job_dir, filename_base)
+    async with job_scheduler.stage('download'):
+        progress.set_stage('Downloading')
+        # Download from the probed metadata first, then from the URL in case it went stale
+        for attempt_info_json_path in ([info_json_path, None] if info_json_path else [None]):
+            cmd = build_video_command(refined_url, video_path, settings, format_selection, attempt_info_json_path)
+            logger.info(f"Running yt-dlp command: {' '.join(cmd)}")
+            with stage_timer('download'):
+                success, stdout, stderr = await run_ytdlp_command(cmd, settings, progress)
+            if success:
+                break
+            preflight_cache.pop(refined_url, None)
+
+    if not success:
+        metrics.inc('video_dl_stage_failures_total', stage='download')
+        # Extract meaningful error message from stderr
+        error_lines = [line for line in stderr.split('\n') if 'ERROR' in line or 'error' in line.lower()]
+        error_msg = '\n'.join(error_lines[-3:]) if error_lines else stderr[-500:] if stderr else 'Unknown error'
+        logger.error(f"Download failed: {stderr}")
+        await update.message.reply_text(f"Download failed:\n{error_msg}")
+        return None
+
+    logger.info("Video downloaded successfully!")
+    logger.debug(f"yt-dlp output:\n{stdout}")
+
+    output_paths = parse_output_paths(stdout)
+    if not output_paths:
+        logger.error(f"yt-dlp did not report an output file for {refined_url}")
+        await update.message.reply_text(f"Download completed but file not found. Check logs for details.")
+        return None
+    video_file_path = output_paths[-1]
+
+    video_size = os.path.getsize(video_file_path)
+    metrics.inc('video_dl_downloaded_bytes_total', video_size)
+    await update.message.reply_text(f"Video downloaded: {os.path.basename(video_file_path)} ({video_size / MB_IN_BYTES:.2f} MB)")
+    return video_file_path
+
+async def download_audio_only(update: Update, context: CallbackContext, url: str, filename_base: str, settings: dict, job_dir: str, progress: ProgressTracker = None) -> None:
     """Download audio only version of the content"""
-    audio_path = f'{SUBDIR}/{filename_base}'
-    cmd = build_audio_command(url, audio_path, settings)
-    logger.info(f"Running yt-dlp audio command: {' '.join(cmd)}")
+    cache_key = make_cache_key(url, {**settings, 'audio_only': True})
+    cached_items = get_cached_files(cache_key)
+    if cached_items is not None:
+        await send_cached_files(update, context, cached_items)
+        return
+
+    audio_path = os.path.join(job_dir, filename_base)
+    # Metadata read when the link's batch was resolved saves extracting the URL again
+    info = get_probed_info(url)
+    info_json_path = write_info_json(info, job_dir) if info is not None else None
+    if not await reserve_job_space(update, url, job_dir, estimate_audio_size(info) if info is not None else None, progress, audio_only=True):
+        return
 
-    success, stdout, stderr = run_ytdlp_command(cmd)
+    async with job_scheduler.stage('download'):
+        if progress is not None:
+            progress.set_stage('Downloading')
+        for attempt_info_json_path in ([info_json_path, None] if info_json_path else [None]):
+            cmd = build_audio_command(url, audio_path, settings, attempt_info_json_path)
+            logger.info(f"Running yt-dlp audio command: {' '.join(cmd)}")
+            with stage_timer('download'):
+                success, stdout, stderr = await run_ytdlp_command(cmd, settings, progress)
+            if success:
+                break
+            preflight_cache.pop(url, None)
 
     if not success:
+        metrics.inc('video_dl_stage_failures_total', stage='download')
         error_lines = [line for line in stderr.split('\n') if 'ERROR' in line or 'error' in line.lower()]
         error_msg = '\n'.join(error_lines[-3:]) if error_lines else stderr[-500:] if stderr else 'Unknown error'
         logger.error(f"Audio download failed: {stderr}")
         await update.message.reply_text(f"Audio download failed:\n{error_msg}")
         return
 
-    try:
-        audio_file_path = find_downloaded_file(filename_base)
-    except FileNotFoundError as e:
-        logger.error(f"Could not find downloaded audio file: {e}")
+    output_paths = parse_output_paths(stdout)
+    if not output_paths:
+        logger.error(f"yt-dlp did not report an audio output file for {url}")
         await update.message.reply_text(f"Audio download completed but file not found.")
         return
+    audio_file_path = output_paths[-1]
+    metrics.inc('video_dl_downloaded_bytes_total', os.path.getsize(audio_file_path))
 
+    await send_audio_file(update, context, audio_file_path, url, cache_key)
+
+async def extract_and_send_audio(update: Update, context: CallbackContext, video_file_path: str, url: str, filename_base: str, settings: dict) -> None:
+    """Build the audio version from an already downloaded video instead of fetching the URL again"""
+    cache_key = make_cache_key(url, {**settings, 'audio_only': True})
+    cached_items = get_cached_files(cache_key)
+    if cached_items is not None:
+        await send_cached_files(update, context, cached_items)
+        return
+
+    audio_file_path = None
     try:
-        with open(audio_file_path, 'rb') as audio_file:
-            await context.bot.send_audio(
+        # Copy the audio track as is when its codec is wanted, otherwise convert it
+        audio_codecs = [stream.get('codec_name') for stream in await probe_streams(video_file_path) if stream.get('codec_type') == 'audio']
+        copy_extension = AUDIO_COPY_EXTENSIONS.get(audio_codecs[0]) if audio_codecs else None
+        if copy_extension and AUDIO_FORMAT in ('best', copy_extension):
+            audio_file_path = os.path.join(os.path.dirname(video_file_path), f'{filename_base}.{copy_extension}')
+            with stage_timer('extract_audio'):
+                await check_process(['ffmpeg', '-y', '-nostats', '-v', 'error', '-i', video_file_path, '-map', '0:a:0', '-vn', '-c:a', 'copy', audio_file_path], timeout=None)
+        else:
+            audio_format = 'mp3' if AUDIO_FORMAT == 'best' else AUDIO_FORMAT
+            audio_file_path = os.path.join(os.path.dirname(video_file_path), f'{filename_base}.{audio_format}')
+            cmd = ['ffmpeg', '-y', '-nostats', '-v', 'error', '-i', video_file_path, '-map', '0:a:0', '-vn']
+            if audio_format == 'mp3':
+                cmd.extend(['-c:a', 'libmp3lame', '-q:a', '0'])  # Same quality as yt-dlp --audio-quality 0
+            cmd.append(audio_file_path)
+            async with job_scheduler.stage('transcode'):
+                with stage_timer('extract_audio'):
+                    await check_process(cmd, timeout=None)
+    except Exception as e:
+        logger.error(f"Audio extraction failed: {e}")
+        await update.message.reply_text("Audio extraction failed. The video may not have an audio track.")
+        if audio_file_path and os.path.exists(audio_file_path):
+            os.remove(audio_file_path)
+        return
+
+    await send_audio_file(update, context, audio_file_path, url, cache_key)
+
+async def send_audio_file(update: Update, context: CallbackContext, audio_file_path: str, url: str, cache_key: str) -> None:
+    """Send an audio file, remember its file_id and remove it"""
+    async def send() -> object:
+        timeout = upload_timeout(os.path.getsize(audio_file_path))
+        with open_upload(audio_file_path) as audio_file:
+            return await context.bot.send_audio(
                 chat_id=update.effective_chat.id,
                 audio=audio_file,
-                caption=f"Audio from {url}"
+                caption=f"Audio from {url}",
+                write_timeout=timeout,
+                read_timeout=timeout,
+                connect_timeout=30.0
             )
+
+    try:
+        message = await upload_with_retry(os.path.basename(audio_file_path), send)
+        metrics.inc('video_dl_uploaded_bytes_total', os.path.getsize(audio_file_path))
+        store_cached_files(cache_key, [{'type': 'audio', 'file_id': get_sent_file_id(message), 'caption': f"Audio from {url}"}])
     except Exception as e:
         logger.error(f"Failed to send audio: {e}")
         await update.message.reply_text(f"Failed to send audio: {e}")
@@ -469,85 +2698,310 @@ async def download_audio_only(update: Update, context: CallbackContext, url: str
         if os.path.exists(audio_file_path):
             os.remove(audio_file_path)
 
-async def split_and_send_video(update: Update, context: CallbackContext, full_file_path: str, filename_base: str) -> None:
-    await update.message.reply_text("The video is larger than 50MB. Splitting it into smaller chunks...")
+async def get_video_duration(file_path: str) -> float:
+    """Return the container duration of a media file in seconds using ffprobe."""
+    with stage_timer('ffprobe'):
+        output = await check_process([
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+            '-of', 'default=noprint_wrappers=1:nokey=1', file_path
+        ], timeout=60)
+    return float(output.strip())
+
+async def plan_split_frames(file_path: str, max_part_bytes: float) -> list:
+    """Choose keyframes to cut at so every part stays under `max_part_bytes`.
+
+    Reads the packet index with ffprobe and greedily extends each part up to the last
+    keyframe that still fits, which gives the fewest parts. Packet sizes leave out the
+    container overhead, so the budget is scaled by the file's ratio of packet bytes to
+    file size. Returns the video frame numbers to pass to the segment muxer's
+    -segment_frames option; raises ValueError if the file can't be cut at a keyframe.
+    """
+    output = await check_process([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=index',
+        '-of', 'csv=p=0', file_path
+    ], timeout=60)
+    video_index = int(output.strip().splitlines()[0])
+
+    keyframes = []  # (frame, bytes of all packets before it) of every keyframe after the first frame
+    state = {'bytes': 0, 'frames': 0}
+
+    def on_line(line: str) -> None:
+        # Fields: stream_index,size,flags
+        fields = line.strip().split(',')
+        if len(fields) < 3 or not fields[0].isdigit() or not fields[1].isdigit():
+            return
+        if int(fields[0]) == video_index:
+            if 'K' in fields[2] and state['frames'] > 0:
+                keyframes.append((state['frames'], state['bytes']))
+            state['frames'] += 1
+        state['bytes'] += int(fields[1])
+
+    with stage_timer('ffprobe'):
+        await check_process([
+            'ffprobe', '-v', 'error', '-show_entries', 'packet=stream_index,size,flags',
+            '-of', 'csv=p=0', file_path
+        ], on_line=on_line)
+    if not state['frames']:
+        raise ValueError("no video packets found")
+
+    file_size = os.path.getsize(file_path)
+    packet_budget = max_part_bytes * min(1.0, state['bytes'] / file_size)
+    cut_frames = []
+    start, last_key = (0, 0), None
+    for frame, offset in keyframes + [(None, state['bytes'])]:
+        if offset - start[1] > packet_budget:
+            if last_key is not None and last_key[0] > start[0]:
+                cut_frames.append(last_key[0])
+                start = last_key
+            if frame is not None and offset - start[1] > packet_budget:
+                # A single GOP is larger than a part, cutting at the next keyframe is the best we can do
+                cut_frames.append(frame)
+                start = (frame, offset)
+        last_key = (frame, offset)
+
+    if not cut_frames and file_size > max_part_bytes:
+        # The packets fit but the file doesn't: cut at the keyframe closest to the middle
+        if not keyframes:
+            raise ValueError("no keyframe to cut at")
+        cut_frames.append(min(keyframes, key=lambda key: abs(key[1] - state['bytes'] / 2))[0])
+    logger.info(
+        f"Planned {len(cut_frames) + 1} parts for {file_path} "
+        f"({state['bytes'] / MB_IN_BYTES:.2f} MB of packets in {file_size / MB_IN_BYTES:.2f} MB)"
+    )
+    return cut_frames
+
+async def split_and_send_video(update: Update, context: CallbackContext, full_file_path: str, filename_base: str, job_id=None):
+    """Split a video into parts and send them. Returns the file_ids if every part was sent, otherwise None.
 
-    file_size = os.path.getsize(full_file_path)
-    num_parts = math.ceil(file_size / (SPLIT_SIZE_LIMIT_MB * MB_IN_BYTES))
-    duration = float(subprocess.check_output(f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 {shlex.quote(full_file_path)}", shell=True).decode().strip())
-    segment_duration = duration / num_parts
+    Parts are uploaded as soon as ffmpeg finishes writing them, while the next ones are still being cut.
+    A resumed job cuts the same parts again and skips the ones it already sent.
+    """
+    await update.message.reply_text(f"The video is larger than {UPLOAD_SIZE_LIMIT_MB}MB. Splitting it into smaller chunks...")
+
+    try:
+        cut_frames = await plan_split_frames(full_file_path, UPLOAD_SIZE_LIMIT_MB * MB_IN_BYTES * SPLIT_SIZE_MARGIN)
+        if not cut_frames:
+            raise ValueError("the file already fits in one part")
+        num_parts = len(cut_frames) + 1
+        segment_options = ['-segment_frames', ','.join(map(str, cut_frames))]
+    except Exception as e:
+        # Fall back to equal-length parts sized by SPLIT_SIZE_LIMIT_MB
+        logger.warning(f"Could not read the keyframe index of {full_file_path}, splitting by duration: {e}")
+        file_size = os.path.getsize(full_file_path)
+        num_parts = math.ceil(file_size / (min(SPLIT_SIZE_LIMIT_MB, UPLOAD_SIZE_LIMIT_MB * SPLIT_SIZE_MARGIN) * MB_IN_BYTES))
+        duration = await get_video_duration(full_file_path)
+        segment_options = ['-segment_time', str(duration / num_parts)]
 
     # Get the original file extension
     _, file_extension = os.path.splitext(full_file_path)
+    part_prefix = f"{filename_base}_"
+    part_dir = os.path.dirname(full_file_path)
+
+    # The segment list is written to stdout one line per finished part
+    split_command = [
+        'ffmpeg', '-y', '-nostats', '-v', 'error', '-i', full_file_path, '-c', 'copy', '-map', '0',
+        *segment_options, '-f', 'segment', '-reset_timestamps', '1',
+        '-segment_list', 'pipe:1', '-segment_list_type', 'flat',
+        os.path.join(part_dir, f"{part_prefix}%03d{file_extension}")
+    ]
+    ready_parts = asyncio.Queue()
 
-    split_command = f"ffmpeg -i {shlex.quote(full_file_path)} -c copy -map 0 -segment_time {segment_duration} -f segment -reset_timestamps 1 {SUBDIR}/{filename_base}_%03d{file_extension}"
-    subprocess.run(split_command, shell=True, check=True)
+    def on_line(line: str) -> None:
+        name = line.strip()
+        if name.startswith(part_prefix) and name.endswith(file_extension):
+            ready_parts.put_nowait(os.path.join(part_dir, name))
 
-    success_count = 0
-    failed_parts = []
-    
-    for i in range(0, num_parts):
-        split_file = f"{SUBDIR}/{filename_base}_{i:03d}{file_extension}"
-        j = i + 1
-        await update.message.reply_text(f"Sending part {j} of {num_parts}...")
+    async def produce_parts() -> None:
         try:
-            await send_video(update, context, split_file)
-            success_count += 1
-        except Exception as e:
-            error_message = str(e)
-            await update.message.reply_text(f"Failed to send part {j}: {error_message}")
-            logger.error(f"Failed to send part {j}: {error_message}")
-            failed_parts.append(j)
+            async with job_scheduler.stage('transcode'):
+                with stage_timer('split'):
+                    await check_process(split_command, timeout=None, on_line=on_line)
         finally:
-            if os.path.exists(split_file):
+            ready_parts.put_nowait(None)
+
+    artifacts = journal_artifacts(job_id)
+    parts_done = artifacts.get('parts_done', 0)
+    failed_parts = artifacts.get('failed_parts', [])
+    sent_file_ids = artifacts.get('sent_parts', [])
+    success_count = len(sent_file_ids)
+    producer = asyncio.ensure_future(produce_parts())
+    j = 0
+
+    try:
+        finished = False
+        while not finished:
+            # Send every part that is ready by now together, up to UPLOAD_GROUP_SIZE
+            batch = [await ready_parts.get()]
+            while batch[-1] is not None and len(batch) < UPLOAD_GROUP_SIZE and not ready_parts.empty():
+                batch.append(ready_parts.get_nowait())
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            # Parts sent before a restart are cut again but not resent
+            skipped = max(0, min(len(batch), parts_done - j))
+            for split_file in batch[:skipped]:
                 os.remove(split_file)
+            j += skipped
+            batch = batch[skipped:]
+            if not batch:
+                continue
+            first = j + 1
+            j += len(batch)
+            part_numbers = f"part {first}" if len(batch) == 1 else f"parts {first}-{j}"
+            await update.message.reply_text(f"Sending {part_numbers} of {max(num_parts, j)}...")
+            try:
+                sent_file_ids.extend(await send_video_group(update, context, batch))
+                success_count += len(batch)
+            except Exception as e:
+                error_message = str(e)
+                await update.message.reply_text(f"Failed to send {part_numbers}: {error_message}")
+                logger.error(f"Failed to send {part_numbers}: {error_message}")
+                failed_parts.extend(range(first, j + 1))
+            finally:
+                for split_file in batch:
+                    if os.path.exists(split_file):
+                        os.remove(split_file)
+            journal_update(job_id, 'splitting', parts_done=j, sent_parts=sent_file_ids, failed_parts=failed_parts)
+        # Re-raise a splitting error once the finished parts are sent
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+        # Remove parts that were never sent, including a half-written one after a failure
+        for leftover in glob.glob(os.path.join(glob.escape(part_dir), f"{glob.escape(part_prefix)}[0-9][0-9][0-9]{glob.escape(file_extension)}")):
+            os.remove(leftover)
 
     logger.info("All split parts processed.")
-    
-    if success_count == num_parts:
+
+    if success_count == j:
         await update.message.reply_text("All video parts sent successfully.")
+        return sent_file_ids
     else:
-        await update.message.reply_text(f"Sent {success_count} of {num_parts} parts. Failed parts: {', '.join(map(str, failed_parts))}")
+        await update.message.reply_text(f"Sent {success_count} of {j} parts. Failed parts: {', '.join(map(str, failed_parts))}")
+        return None
+
+def local_file_uri(file_path: str) -> str:
+    """Return the file:// URI the local Bot API server reads a file from"""
+    path = os.path.abspath(file_path)
+    if LOCAL_BOT_API_DIR:
+        path = os.path.join(LOCAL_BOT_API_DIR, os.path.relpath(path, os.path.abspath(SUBDIR)))
+    return pathlib.PurePosixPath(path).as_uri()
+
+@contextmanager
+def open_upload(file_path: str):
+    """Yield what to upload for a file: its path in local Bot API mode, otherwise the open file to stream"""
+    if LOCAL_BOT_API:
+        yield local_file_uri(file_path)
+    else:
+        with open(file_path, 'rb') as file:
+            yield file
 
-async def send_video(update: Update, context: CallbackContext, file_path: str) -> None:
-    try:
-        with open(file_path, 'rb') as video_file:
-            await context.bot.send_document(
+def upload_timeout(size_bytes: int) -> float:
+    """Read/write timeout for uploading `size_bytes`, allowing for UPLOAD_MIN_SPEED_MBPS"""
+    return max(UPLOAD_MIN_TIMEOUT, size_bytes / MB_IN_BYTES / UPLOAD_MIN_SPEED_MBPS)
+
+async def upload_with_retry(description: str, send):
+    """Run an upload in the upload worker pool, retrying network errors with exponential backoff.
+
+    `send` is a callable returning a new upload coroutine, so files are reopened for every attempt.
+    Flood control waits are taken from RetryAfter; other Telegram errors are not retried.
+    """
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            async with job_scheduler.stage('upload'):
+                with stage_timer('upload'):
+                    return await send()
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            if attempt == UPLOAD_RETRIES:
+                raise
+        except BadRequest:
+            raise
+        except NetworkError:
+            delay = UPLOAD_RETRY_DELAY * 2 ** attempt
+            if attempt == UPLOAD_RETRIES:
+                raise
+        metrics.inc('video_dl_upload_retries_total')
+        logger.warning(f"Upload of {description} failed (attempt {attempt + 1}), retrying in {delay:.0f}s")
+        await asyncio.sleep(delay)
+
+async def send_video(update: Update, context: CallbackContext, file_path: str) -> str:
+    """Send a video file as a document and return its Telegram file_id."""
+    async def send() -> object:
+        timeout = upload_timeout(os.path.getsize(file_path))
+        with open_upload(file_path) as video_file:
+            return await context.bot.send_document(
                 chat_id=update.effective_chat.id,
                 document=video_file,
                 filename=os.path.basename(file_path),
-                write_timeout=60.0,
-                read_timeout=60.0,
+                write_timeout=timeout,
+                read_timeout=timeout,
                 connect_timeout=30.0
             )
+
+    try:
+        message = await upload_with_retry(os.path.basename(file_path), send)
+        metrics.inc('video_dl_uploaded_bytes_total', os.path.getsize(file_path))
+        return get_sent_file_id(message)
     except Exception as e:
         error_message = str(e)
         logger.error(f"Failed to send video file {file_path}: {error_message}")
         raise  # Re-raise to be handled by the caller
 
-def find_downloaded_file(filename_base: str) -> str:
-    for file in os.listdir(SUBDIR):
-        if file.startswith(filename_base):
-            return f"{SUBDIR}/{file}"
-    raise FileNotFoundError(f"The file with base name {filename_base} was not found in {SUBDIR}.")
+async def send_video_group(update: Update, context: CallbackContext, file_paths: list) -> list:
+    """Send several video files as one album of documents and return their file_ids in order."""
+    if len(file_paths) == 1:
+        return [await send_video(update, context, file_paths[0])]
+
+    async def send() -> object:
+        timeout = upload_timeout(sum(os.path.getsize(file_path) for file_path in file_paths))
+        with ExitStack() as stack:
+            media = [
+                InputMediaDocument(stack.enter_context(open_upload(file_path)), filename=os.path.basename(file_path))
+                for file_path in file_paths
+            ]
+            return await context.bot.send_media_group(
+                chat_id=update.effective_chat.id,
+                media=media,
+                write_timeout=timeout,
+                read_timeout=timeout,
+                connect_timeout=30.0
+            )
+
+    try:
+        messages = await upload_with_retry(f"{len(file_paths)} parts", send)
+        metrics.inc('video_dl_uploaded_bytes_total', sum(os.path.getsize(file_path) for file_path in file_paths))
+        return [get_sent_file_id(message) for message in messages]
+    except Exception as e:
+        logger.error(f"Failed to send video files {', '.join(file_paths)}: {e}")
+        raise
 
 def main() -> None:
     # Check if downloads directory exists
     if not os.path.exists(SUBDIR):
         os.makedirs(SUBDIR)
-        
+    unfinished_jobs.extend(load_job_journal())
+    remove_stale_job_dirs({job['artifacts'].get('job_dir') for job in unfinished_jobs})
+
     load_settings()
+    load_file_id_cache()
     application = Application.builder()\
         .token(BOT_TOKEN)\
-        .base_url("http://127.0.0.1:8081/bot")\
+        .base_url(BOT_API_BASE_URL)\
+        .local_mode(LOCAL_BOT_API)\
+        .connection_pool_size(BOT_API_CONNECTIONS)\
+        .pool_timeout(BOT_API_POOL_TIMEOUT)\
+        .post_init(post_init)\
+        .post_shutdown(post_shutdown)\
         .build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("settings", settings_command))
     application.add_handler(CommandHandler("set_proxy", set_proxy_command))
     application.add_handler(CommandHandler("set_cookies", set_cookies_command))
+    application.add_handler(CommandHandler("refresh", refresh_command))
     application.add_handler(CallbackQueryHandler(settings_button))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, download_video))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     application.run_polling()
 